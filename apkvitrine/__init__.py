@@ -54,9 +54,12 @@ _DEFAULT_CONFIG = {
         # distro (str)
         # repos (maplist)
         # index (str)
+        "index.cache": "", # path
         "ignore": "", # list
         "startdirs": "", # map
 
+        "tracker.cache": "", # path
+
         "bz.api": "", # str
         # bz.product (str)
         # bz.component (str)
@@ -65,10 +68,18 @@ _DEFAULT_CONFIG = {
 
         "gl.api": "", # str
         # gl.branch (str)
+        "gl.connections": "8", # int
 
         # cgi.default_version (str)
         # cgi.data (str)
         "cgi.cache": "", # str
+        "cgi.cache_size": "268435456", # int
+        "cgi.cache_entries": "0", # int
+        "cgi.memory_cache": "0", # int
+        "cgi.max_age": "0", # int
+        "cgi.mmap_size": "268435456", # int
+        "cgi.server": "threaded", # str
+        "cgi.workers": "8", # int
 
         "web.pagination": "25", # int
         "web.url.rev": "", # str
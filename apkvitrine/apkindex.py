@@ -0,0 +1,88 @@
+# SPDX-License-Identifier: NCSA
+# Copyright (c) 2021 Max Rees
+# See LICENSE for more information.
+import gzip           # GzipFile
+import sys            # intern
+import tarfile        # open
+import urllib.request # urlopen
+
+# Bumped whenever IndexPkg changes so that stale pickles are not reused
+FORMAT = 2
+
+class IndexPkg: # pylint: disable=too-few-public-methods,too-many-instance-attributes
+    __slots__ = (
+        "name",
+        "version",
+        "origin",
+        "description",
+        "url",
+        "license",
+        "maintainer",
+        "commit",
+        "size",
+        "builddate",
+        "provides",
+        "depends",
+        "provider_priority",
+        "repo",
+    )
+
+    def __init__(self, fields):
+        # Most strings recur across architectures and subpackages, so
+        # share them
+        _intern = sys.intern
+        self.name = name = _intern(fields["P"])
+        self.version = _intern(fields["V"]) if "V" in fields else None
+        self.origin = _intern(fields.get("o") or name)
+        self.description = _intern(fields.get("T") or name)
+        self.url = _intern(fields["U"]) if "U" in fields else None
+        self.license = _intern(fields["L"]) if "L" in fields else None
+        self.maintainer = _intern(fields["m"]) if "m" in fields else None
+        self.commit = _intern(fields["c"]) if "c" in fields else None
+        self.size = int(fields.get("I", 0))
+        self.builddate = int(fields.get("t", 0))
+        self.provides = tuple(_intern(i) for i in fields.get("p", "").split())
+        self.depends = tuple(_intern(i) for i in fields.get("D", "").split())
+        self.provider_priority = int(fields["k"]) if "k" in fields else None
+        self.repo = None
+
+    def __repr__(self):
+        return f"IndexPkg({self.name!r}, {self.version!r})"
+
+# Only the fields that the database builder uses are kept
+_FIELDS = frozenset("PVoTULmcItpDk")
+
+def parse(lines):
+    fields = {}
+    for line in lines:
+        line = line.decode("utf-8").strip()
+        if not line:
+            if "P" in fields:
+                yield IndexPkg(fields)
+            fields = {}
+            continue
+
+        key, sep, value = line.partition(":")
+        if sep and key in _FIELDS:
+            fields[key] = value.strip()
+
+    if "P" in fields:
+        yield IndexPkg(fields)
+
+def read(fileobj):
+    # APKINDEX.tar.gz is a signature tarball and an index tarball each
+    # compressed as separate gzip members, which tarfile's own streaming
+    # gzip support cannot handle
+    with gzip.GzipFile(fileobj=fileobj, mode="rb") as gz, \
+            tarfile.open(fileobj=gz, mode="r|") as tar:
+        for member in tar:
+            if member.name != "APKINDEX":
+                continue
+            yield from parse(tar.extractfile(member))
+            return
+
+    raise ValueError("APKINDEX not found in archive")
+
+def fetch(url):
+    with urllib.request.urlopen(url) as response:
+        yield from read(response)
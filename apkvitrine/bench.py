@@ -0,0 +1,319 @@
+# SPDX-License-Identifier: NCSA
+# Copyright (c) 2021 Max Rees
+# See LICENSE for more information.
+import argparse    # ArgumentParser, Namespace
+import gzip        # compress
+import io          # BytesIO
+import json        # dumps, loads
+import logging
+import random      # Random
+import sys         # exit
+import tarfile     # open, TarInfo
+import tempfile    # mkdtemp
+from pathlib import Path
+
+import apkvitrine
+import apkvitrine.build_db # build, write_atomic
+
+SIZES = (1000, 10000, 100000)
+REPOS = ("system", "user")
+ARCHES = ("x86_64", "pmmx", "ppc")
+
+def _tarball(name, data, end=True):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w") as tar:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    data = buf.getvalue()
+    if not end:
+        # Like abuild-sign, leave out the end-of-archive blocks so that
+        # the members can be concatenated
+        data = data[:512 + (info.size + 511) // 512 * 512]
+    return gzip.compress(data, compresslevel=1)
+
+def _version(rng):
+    ver = ".".join(str(rng.randrange(20)) for _ in range(rng.randrange(1, 4)))
+    roll = rng.random()
+    if roll < 0.05:
+        ver += rng.choice("abc")
+    elif roll < 0.15:
+        ver += f"_{rng.choice(('alpha', 'beta', 'rc', 'p', 'git'))}"
+        ver += str(rng.randrange(1, 10))
+    return f"{ver}-r{rng.randrange(4)}"
+
+def distro(packages, *, subpackages=2.0, provides=0.3, fanout=4.0, seed=0):
+    # Returns the packages of every repository as a list of origins, each
+    # a list of field dicts. The first entry of an origin is the origin
+    # itself.
+    rng = random.Random(seed)
+    origins = []
+    names = []
+    sonames = []
+    total = 0
+    while total < packages:
+        repo = REPOS[0] if rng.random() < 0.4 else REPOS[1]
+        origin = f"{repo[0]}{len(origins)}-{rng.choice(('lib', 'py3', 'x'))}"
+        subs = [origin] + [
+            f"{origin}-{sub}" for sub in
+            ("dev", "doc", "libs", "openrc", "lang", "dbg", "bash-completion")
+            [:min(7, int(rng.expovariate(1 / subpackages)))]
+        ]
+        version = _version(rng)
+        pkgs = []
+        for name in subs:
+            fields = {
+                "P": name,
+                "V": version,
+                "T": f"{name} package for benchmarking",
+                "U": f"https://example.org/{origin}",
+                "L": rng.choice(("MIT", "GPL-2.0-only", "BSD-3-Clause")),
+                "o": origin,
+                "m": f"Maintainer {rng.randrange(50)} <m@example.org>",
+                "c": f"{rng.getrandbits(160):040x}",
+                "I": str(rng.randrange(1, 10**7)),
+                "t": str(1600000000 + rng.randrange(10**7)),
+                "repo": repo,
+            }
+            provs = []
+            if rng.random() < provides:
+                provs.append(f"so:lib{name}.so.{rng.randrange(1, 4)}=1")
+                sonames.append(provs[-1].split("=")[0])
+            if rng.random() < provides / 2:
+                provs.append(f"cmd:{name}")
+            if provs:
+                fields["p"] = " ".join(provs)
+            if rng.random() < 0.01:
+                fields["k"] = str(rng.randrange(1, 100))
+            pkgs.append(fields)
+            names.append(name)
+        origins.append(pkgs)
+        total += len(pkgs)
+
+    for pkgs in origins:
+        for fields in pkgs:
+            deps = []
+            for _ in range(int(rng.expovariate(1 / fanout)) if fanout else 0):
+                roll = rng.random()
+                if roll < 0.3 and sonames:
+                    deps.append(rng.choice(sonames))
+                elif roll < 0.4:
+                    dep = rng.choice(names)
+                    deps.append(f"{dep}>={rng.randrange(3)}.{rng.randrange(9)}")
+                elif roll < 0.42:
+                    deps.append(f"!{rng.choice(names)}")
+                elif roll < 0.43:
+                    deps.append(f"missing-{rng.randrange(100)}")
+                else:
+                    deps.append(rng.choice(names))
+            if deps:
+                fields["D"] = " ".join(deps)
+
+    return origins
+
+def write_indices(root, origins, *, arches=ARCHES, seed=0):
+    rng = random.Random(seed)
+    indices = {(repo, arch): [] for repo in REPOS for arch in arches}
+    for pkgs in origins:
+        repo = pkgs[0]["repo"]
+        for arch in arches:
+            # Not every origin is built everywhere, and some arches lag
+            # behind with an older version
+            roll = rng.random()
+            if arch != arches[0] and roll < 0.05:
+                continue
+            version = pkgs[0]["V"]
+            if arch != arches[0] and roll < 0.15:
+                version = version.replace("-r", ".0-r", 1) \
+                    if rng.random() < 0.5 else "0." + version
+            for fields in pkgs:
+                entry = [f"C:Q1{rng.getrandbits(120):030x}="]
+                entry += [
+                    f"{key}:{value}" for key, value in fields.items()
+                    if key not in ("V", "repo")
+                ]
+                entry += [f"V:{version}", f"A:{arch}"]
+                indices[repo, arch].append("\n".join(entry) + "\n\n")
+
+    for (repo, arch), entries in indices.items():
+        path = root / repo / arch
+        path.mkdir(parents=True, exist_ok=True)
+        data = b"".join((
+            _tarball(".SIGN.RSA.bench.rsa.pub", b"\0" * 256, end=False),
+            _tarball("DESCRIPTION", b"bench", end=False),
+            _tarball("APKINDEX", "".join(entries).encode("utf-8")),
+        ))
+        apkvitrine.build_db.write_atomic(path / "APKINDEX.tar.gz", data)
+
+def generate(root, packages, *, arches=ARCHES, seed=0, **kwargs):
+    stamp = root / "distro.json"
+    params = {"packages": packages, "arches": list(arches), "seed": seed}
+    params.update(kwargs)
+    try:
+        if json.loads(stamp.read_text()) == params:
+            return
+    except (FileNotFoundError, ValueError):
+        pass
+
+    logging.info("Generating %d packages in %s...", packages, root)
+    origins = distro(packages, seed=seed, **kwargs)
+    write_indices(root, origins, arches=arches, seed=seed)
+    stamp.write_text(json.dumps(params))
+
+def bench(workdir, sizes, *, repeat=1, jobs=1, bulk=False, **kwargs):
+    mirror = workdir / "mirror"
+    out = workdir / "out"
+    conf = workdir / "conf"
+    out.mkdir(parents=True, exist_ok=True)
+    conf.mkdir(parents=True, exist_ok=True)
+
+    arches = kwargs.get("arches", ARCHES)
+    ini = [
+        "[@default]",
+        "distro = Bench",
+        "repos = " + "\n        ".join(
+            f"{repo} {' '.join(arches)}" for repo in REPOS
+        ),
+        f"index = {mirror.as_uri()}/{{version}}/{{repo}}/{{arch}}"
+        "/APKINDEX.tar.gz",
+    ]
+    ini += [f"[n{size}]" for size in sizes]
+    (conf / "config.ini").write_text("\n".join(ini) + "\n")
+    apkvitrine.SYSCONFDIR = conf
+
+    results = {}
+    for size in sizes:
+        version = f"n{size}"
+        generate(mirror / version, size, **kwargs)
+        opts = argparse.Namespace(
+            dir=out, jobs=jobs, incremental=False, bulk=bulk,
+        )
+
+        result = None
+        for _ in range(repeat):
+            apkvitrine.build_db.build(opts, version)
+            report = json.loads((out / f"{version}.report.json").read_text())
+            if result is None:
+                result = {
+                    "packages": report["tables"]["packages"],
+                    "max_rss": report["max_rss"],
+                    "phases": {
+                        phase: {"wall": stats["wall"], "cpu": stats["cpu"]}
+                        for phase, stats in report["phases"].items()
+                    },
+                }
+                continue
+
+            # Keep the best time of each phase to reduce the noise
+            for phase, stats in report["phases"].items():
+                for key in ("wall", "cpu"):
+                    result["phases"][phase][key] = min(
+                        result["phases"][phase][key], stats[key],
+                    )
+        results[str(size)] = result
+
+    return results
+
+def compare(results, baseline, threshold):
+    ok = True
+    for size, result in results.items():
+        base = baseline.get(size, {}).get("phases", {})
+        print(f"{size} packages ({result['packages']} rows):")
+        print(f"  {'phase':10} {'wall':>9} {'us/pkg':>9} {'baseline':>9} ratio")
+        for phase, stats in result["phases"].items():
+            wall = stats["wall"]
+            per_pkg = wall / max(1, result["packages"]) * 10**6
+            line = f"  {phase:10} {wall:9.3f} {per_pkg:9.1f}"
+            if phase in base:
+                # Ignore noise in phases that are too short to measure
+                ratio = wall / max(base[phase]["wall"], 0.01)
+                line += f" {base[phase]['wall']:9.3f} {ratio:5.2f}"
+                if ratio > threshold and wall > 0.05:
+                    line += " REGRESSION"
+                    ok = False
+            print(line)
+    return ok
+
+if __name__ == "__main__":
+    opts = argparse.ArgumentParser(
+        usage="python3 -m apkvitrine.bench [options ...]",
+        description="build databases for synthetic distributions offline and"
+        " compare the build phase timings against a baseline",
+    )
+    opts.add_argument(
+        "-n", "--sizes", type=int, nargs="+", default=SIZES,
+        help="number of packages (per architecture) to generate",
+    )
+    opts.add_argument(
+        "-a", "--arches", nargs="+", default=ARCHES,
+        help="architectures to generate",
+    )
+    opts.add_argument(
+        "--subpackages", type=float, default=2.0,
+        help="average number of subpackages per origin",
+    )
+    opts.add_argument(
+        "--provides", type=float, default=0.3,
+        help="fraction of packages with so: provides",
+    )
+    opts.add_argument(
+        "--fanout", type=float, default=4.0,
+        help="average number of dependencies per package",
+    )
+    opts.add_argument(
+        "--seed", type=int, default=0,
+        help="random seed for the generated distributions",
+    )
+    opts.add_argument(
+        "-w", "--work-directory", dest="workdir",
+        help="directory for the generated indices and databases (reused"
+        " between runs)",
+    )
+    opts.add_argument(
+        "-r", "--repeat", type=int, default=3,
+        help="number of times to build each database, keeping the best time",
+    )
+    opts.add_argument(
+        "-j", "--jobs", type=int, default=1,
+        help="number of APKINDEX files to parse at once",
+    )
+    opts.add_argument(
+        "-b", "--bulk", action="store_true",
+        help="build in bulk mode",
+    )
+    opts.add_argument(
+        "-B", "--baseline",
+        help="JSON file with the results of an earlier run to compare with",
+    )
+    opts.add_argument(
+        "-s", "--save", action="store_true",
+        help="write the results to the baseline file",
+    )
+    opts.add_argument(
+        "-t", "--threshold", type=float, default=1.5,
+        help="slowdown relative to the baseline that counts as a regression",
+    )
+    opts.add_argument(
+        "-v", "--verbose", dest="loglevel",
+        action="store_const", const="INFO", default="ERROR",
+        help="show the build log",
+    )
+    opts = opts.parse_args()
+    logging.basicConfig(level=opts.loglevel)
+
+    workdir = Path(opts.workdir or tempfile.mkdtemp(prefix="apkvitrine-bench."))
+    results = bench(
+        workdir.resolve(), opts.sizes, repeat=opts.repeat,
+        jobs=opts.jobs, bulk=opts.bulk,
+        arches=opts.arches, subpackages=opts.subpackages,
+        provides=opts.provides, fanout=opts.fanout, seed=opts.seed,
+    )
+
+    baseline = {}
+    if opts.baseline and not opts.save:
+        baseline = json.loads(Path(opts.baseline).read_text())
+    ok = compare(results, baseline, opts.threshold)
+    if opts.baseline and opts.save:
+        Path(opts.baseline).write_text(json.dumps(results, indent=2))
+
+    sys.exit(0 if ok else 1)
@@ -2,49 +2,207 @@
 # Copyright (c) 2020 Max Rees
 # See LICENSE for more information.
 import argparse       # ArgumentParser
-import collections    # defaultdict
+import collections    # Counter, defaultdict
+import concurrent.futures # as_completed, ProcessPoolExecutor, ThreadPoolExecutor
 import datetime       # datetime
-import json           # load
+import hashlib        # sha256
+import json           # dumps, load, loads
 import logging
+import os             # replace
+import pickle         # dumps, loads, PickleError
 import pkgutil        # get_data
-import sqlite3        # connect
+import sqlite3        # complete_statement, connect, Connection
+import sys            # exit
+import tempfile       # TemporaryFile
+import urllib.error   # HTTPError
 import urllib.parse   # urlencode
 import urllib.request # Request, urlopen
 from pathlib import Path
 
-from apkkit.base.index import Index
-
 import apkvitrine
+import apkvitrine.apkindex # fetch, FORMAT, read
+import apkvitrine.client # JSONClient
+import apkvitrine.depends # parse_spec, Providers
 import apkvitrine.models
-import apkvitrine.version # APK_OPS, is_older, verkey
+import apkvitrine.stats # count, finish, phase, reset, start, tables, timer
+import apkvitrine.version # cache_clear, cache_info, is_older, verkey
 
 GL_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S.%fZ"
 BZ_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
-def init_db(name):
+# Page size used for databases built in bulk mode
+BULK_PAGE_SIZE = 8192
+# These are replaced by finalize_packages() in bulk mode
+_BULK_TRIGGERS = ("max_size", "pkg_created", "pkg_bugged", "pkg_merged")
+
+def temp_name(name):
+    name = Path(name)
+    return name.with_name(f".{name.name}.tmp")
+
+class _Update(sqlite3.Connection):
+    # An incremental update is a single transaction that only finish_db()
+    # commits, so the web application never sees a half updated database
+    # and a failed update leaves the previous one untouched
+    def commit(self):
+        pass
+
+    def executescript(self, sql_script):
+        # Unlike sqlite3.Connection.executescript(), doesn't commit first
+        statement = ""
+        for line in sql_script.splitlines(keepends=True):
+            statement += line
+            if sqlite3.complete_statement(statement):
+                self.execute(statement)
+                statement = ""
+
+def create_indexes(db):
+    indexes = pkgutil.get_data("apkvitrine", "data/indexes.sql")
+    db.executescript(indexes.decode("utf-8"))
+
+def index_search(db):
+    logging.info("Building search index...")
+    search = pkgutil.get_data("apkvitrine", "data/search.sql")
+    try:
+        db.executescript(search.decode("utf-8"))
+    except sqlite3.OperationalError as err:
+        # e.g. no FTS5 or trigram tokenizer; searches fall back to GLOB
+        logging.warning("Could not build search index: %s", err)
+    db.commit()
+
+def summarize_versions(db):
+    outdated = pkgutil.get_data("apkvitrine", "data/outdated.sql")
+    db.executescript(outdated.decode("utf-8"))
+    db.commit()
+
+def count_packages(db):
+    counts = pkgutil.get_data("apkvitrine", "data/counts.sql")
+    db.executescript(counts.decode("utf-8"))
+    db.commit()
+
+def init_db(name, incremental=False, bulk=False):
+    # Returns the database and whether it is being updated in place
+    if incremental and Path(name).is_file():
+        db = sqlite3.connect(str(name), isolation_level=None, factory=_Update)
+        # Databases from before the maintainers table was added are
+        # rebuilt from scratch
+        have_schema = db.execute("""
+            SELECT 1 FROM sqlite_master
+            WHERE type = 'table' AND name = 'maintainers';
+        """).fetchone()
+        if have_schema:
+            # Databases from older versions may lack some indexes
+            create_indexes(db)
+            db.execute("PRAGMA foreign_keys = ON;")
+            # Readers are locked out once the changes no longer fit in
+            # the page cache and have to be written to the database
+            db.execute("PRAGMA cache_size = -65536;")
+            db.execute("BEGIN;")
+            return db, True
+        db.close()
+
+    # Full rebuilds, including those of databases that could not be
+    # updated in place, are written next to the database and renamed
+    # over it by finish_db()
+    name = temp_name(name)
     try:
         Path(name).unlink()
     except FileNotFoundError:
         pass
     schema = pkgutil.get_data("apkvitrine", "data/schema.sql").decode("utf-8")
     db = sqlite3.connect(str(name))
+    if bulk:
+        # Nothing reads the temporary file until it is complete, so a
+        # crash only loses the build in progress
+        db.execute(f"PRAGMA page_size = {BULK_PAGE_SIZE};")
+        db.execute("PRAGMA journal_mode = OFF;")
+        db.execute("PRAGMA synchronous = OFF;")
+        db.execute("PRAGMA temp_store = MEMORY;")
+        db.execute("PRAGMA cache_size = -65536;")
     db.executescript(schema)
-    return db
-
-def atomize(spec):
-    if not any(i in spec for i in apkvitrine.version.APK_OPS):
-        return spec
-
-    for op in apkvitrine.version.APK_OPS:
-        try:
-            name, _ver = spec.split(op, maxsplit=1)
-        except ValueError:
+    if bulk:
+        # Rather than updating a package on every insert, the columns
+        # that these maintain are filled in once by finish_db()
+        for trigger in _BULK_TRIGGERS:
+            db.execute(f"DROP TRIGGER {trigger};")
+        db.commit()
+    else:
+        create_indexes(db)
+    return db, False
+
+def finish_db(db, name, incremental=False, bulk=False):
+    if bulk:
+        finalize_packages(db)
+        # Indexes are cheaper to create once the tables are filled
+        logging.info("Creating indexes...")
+        create_indexes(db)
+    # Give the query planner statistics for the indexes
+    db.execute("ANALYZE;")
+    # Also commits an incremental update, whose phases don't
+    sqlite3.Connection.commit(db)
+    if bulk:
+        logging.info("Optimizing database...")
+        # The database has to be on disk before it is renamed over the
+        # live one, or a crash could leave a truncated file in its place
+        db.execute("PRAGMA synchronous = NORMAL;")
+        db.execute("VACUUM;")
+    db.close()
+    if not incremental:
+        os.replace(str(temp_name(name)), str(name))
+
+def sync_rows(db, model, rows, key, *, keep=(), prune=True):
+    table = model._table
+    old_factory = db.row_factory
+    db.row_factory = model.factory
+    old = {key(i): i for i in db.execute(f"SELECT * FROM {table};")}
+    db.row_factory = old_factory
+
+    has_id = "id" in model._fields
+    if has_id:
+        cols = [i for i in model._fields if i != "id"]
+        where = ("id",)
+    else:
+        # Rows without IDs are identified entirely by their contents
+        cols = []
+        where = model._fields
+        rows = dict.fromkeys(rows)
+
+    inserts = []
+    updates = []
+    for row in rows:
+        prev = old.pop(key(row), None)
+        if prev is None:
+            inserts.append(row)
             continue
+        if not has_id:
+            continue
+
+        row = row._replace(id=prev.id, **{i: getattr(prev, i) for i in keep})
+        if row != prev:
+            updates.append([getattr(row, i) for i in cols] + [row.id])
 
-        return name
+    if prune:
+        deletes = [[getattr(i, j) for j in where] for i in old.values()]
+    else:
+        deletes = []
+
+    model.insertmany(db, inserts)
+    if updates:
+        sets = ", ".join(f"{i} = ?" for i in cols)
+        db.executemany(f"UPDATE {table} SET {sets} WHERE id = ?;", updates)
+    if deletes:
+        where = " AND ".join(f"{i} = ?" for i in where)
+        db.executemany(f"DELETE FROM {table} WHERE {where};", deletes)
+
+    logging.info(
+        "%s: %d inserted, %d updated, %d deleted",
+        table, len(inserts), len(updates), len(deletes),
+    )
 
-    # Not reached
-    assert False
+def store_rows(db, model, rows, key, incremental=False, **kwargs):
+    if incremental:
+        sync_rows(db, model, rows, key, **kwargs)
+    else:
+        model.insertmany(db, rows)
 
 def pkg_newest(pkgs, new, *, name=None):
     name = new.name if name is None else name
@@ -54,56 +212,212 @@ def pkg_newest(pkgs, new, *, name=None):
         pass
     elif apkvitrine.version.is_older(old.version, new.version):
         pass
-    elif int(old._builddate) < int(new._builddate):
+    elif old.builddate < new.builddate:
         pass
     else:
         new = old
     pkgs[name] = new
 
-def prov_newest(provs, new):
-    pkg_newest(provs, new)
-    for name in new.provides:
-        # apkkit doesn't currently support provider_priority...
-        pkg_newest(provs, new, name=atomize(name))
+# Size of the blocks in which indices are downloaded
+DOWNLOAD_BLOCK = 65536
+
+def download(response, fileobj):
+    # Copies the response to the file a block at a time, and returns the
+    # SHA-256 digest of what was written
+    digest = hashlib.sha256()
+    size = 0
+    for block in iter(lambda: response.read(DOWNLOAD_BLOCK), b""):
+        digest.update(block)
+        fileobj.write(block)
+        size += len(block)
+    apkvitrine.stats.count("http.bytes", size)
+    return digest.hexdigest()
+
+def write_atomic(path, data):
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(str(tmp), str(path))
+
+def fetch_index_cached(cache, url):
+    cache.mkdir(parents=True, exist_ok=True)
+    meta_file = cache / "APKINDEX.json"
+    data_file = cache / "APKINDEX.tar.gz"
+    parsed_file = cache / f"APKINDEX.{apkvitrine.apkindex.FORMAT}.pickle"
 
-def pull_indices(conf, version):
+    try:
+        meta = json.loads(meta_file.read_text())
+    except (FileNotFoundError, ValueError):
+        meta = {}
+    if meta.get("url") != url or not data_file.is_file():
+        meta = {}
+
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("modified"):
+        headers["If-Modified-Since"] = meta["modified"]
+    request = urllib.request.Request(url=url, method="GET", headers=headers)
+
+    tmp = data_file.with_name(data_file.name + ".tmp")
+    try:
+        with apkvitrine.stats.timer("fetch"), \
+                urllib.request.urlopen(request) as response, \
+                tmp.open("wb") as f:
+            digest = download(response, f)
+            etag = response.headers.get("ETag")
+            modified = response.headers.get("Last-Modified")
+        apkvitrine.stats.count("http.requests")
+    except urllib.error.HTTPError as err:
+        apkvitrine.stats.count("http.requests")
+        if err.code != 304 or not meta:
+            raise
+        digest = None
+
+    if digest is None:
+        changed = False
+    else:
+        changed = digest != meta.get("sha256")
+        meta = {
+            "url": url,
+            "etag": etag,
+            "modified": modified,
+            "sha256": digest,
+        }
+        if changed:
+            os.replace(str(tmp), str(data_file))
+        write_atomic(meta_file, json.dumps(meta).encode("utf-8"))
+    try:
+        tmp.unlink()
+    except FileNotFoundError:
+        pass
+
+    if not changed:
+        with apkvitrine.stats.timer("parse"):
+            try:
+                return pickle.loads(parsed_file.read_bytes()), False
+            except (OSError, EOFError, AttributeError, pickle.PickleError):
+                pass
+
+    return read_index(data_file.open("rb"), parsed_file), changed
+
+def read_index(fileobj, parsed_file=None):
+    # A generator, so that the index is parsed while it is merged by the
+    # caller instead of on the thread that fetched it, where the GIL
+    # would serialize parsing anyway. The packages are only all kept at
+    # once if they are to be cached.
+    packages = []
+    with fileobj:
+        for pkg in apkvitrine.apkindex.read(fileobj):
+            if parsed_file:
+                packages.append(pkg)
+            yield pkg
+    if parsed_file:
+        write_atomic(parsed_file, pickle.dumps(packages))
+
+def fetch_index(conf, version, repo, arch):
+    logging.info("Parsing %s/%s...", repo, arch)
+    url = conf["index"].format(version=version, repo=repo, arch=arch)
+    if not conf.get("index.cache"):
+        # Kept on disk rather than in memory until it is parsed
+        f = tempfile.TemporaryFile()
+        with apkvitrine.stats.timer("fetch"), \
+                urllib.request.urlopen(url) as response:
+            download(response, f)
+        apkvitrine.stats.count("http.requests")
+        f.seek(0)
+        return read_index(f), True
+
+    cache = conf.getpath("index.cache") / version / repo / arch
+    return fetch_index_cached(cache, url)
+
+def pull_indices(conf, version, jobs=1):
     all_pkgs = {}
     pkgs = collections.defaultdict(dict)
-    provs = {}
 
-    all_arch = set()
     repos = conf.getmaplist("repos")
-    ignore = conf.getlist("ignore")
-    for repo, arches in repos.items():
-        for arch in arches:
-            logging.info("Parsing %s/%s...", repo, arch)
-            all_arch.add(arch)
-
-            # Noisy
-            logging.disable(logging.INFO)
-            index = Index(
-                url=conf["index"].format(version=version, repo=repo, arch=arch),
+    ignore = set(conf.getlist("ignore"))
+    pairs = [(repo, arch) for repo, arches in repos.items() for arch in arches]
+    changed = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        indices = pool.map(
+            lambda pair: fetch_index(conf, version, *pair), pairs,
+        )
+
+        # Merge in configuration order so that the result does not depend
+        # on which worker finished first. Each index is released as soon
+        # as it has been merged.
+        for (repo, arch), (index, new_index) in zip(pairs, indices):
+            if new_index:
+                changed.append(f"{repo}/{arch}")
+            with apkvitrine.stats.timer("parse"):
+                merge_index(all_pkgs, pkgs, index, repo, arch, ignore)
+            del index
+
+    if changed:
+        logging.info("Changed indices: %s", ", ".join(changed))
+    else:
+        logging.info("No indices changed")
+
+    return all_pkgs, pkgs
+
+def merge_index(all_pkgs, pkgs, index, repo, arch, ignore):
+    for new in index:
+        if new.name in ignore:
+            logging.info("Ignoring %r", new.name)
+            continue
+        if new.origin in ignore:
+            logging.info(
+                "Pruning %r from ignored origin %r",
+                new.name, new.origin,
             )
-            logging.disable(logging.NOTSET)
+            continue
+        new.repo = repo
+        pkg_newest(all_pkgs, new)
+        pkg_newest(pkgs[arch], new)
+
+def _pkg_key(pkg):
+    return pkg.name
+
+# Computed from other tables rather than taken from the index
+_PKG_KEEP = ("size", "updated")
+
+def log_cache_info():
+    for name, info in apkvitrine.version.cache_info().items():
+        total = info.hits + info.misses
+        logging.info(
+            "%s cache: %d hits, %d misses (%.1f%%), %d/%d entries",
+            name, info.hits, info.misses,
+            100 * info.hits / total if total else 0,
+            info.currsize, info.maxsize,
+        )
 
-            for new in index.packages:
-                if new.name in ignore:
-                    logging.info("Ignoring %r", new.name)
-                    continue
-                if new.origin in ignore:
-                    logging.info(
-                        "Pruning %r from ignored origin %r",
-                        new.name, new.origin,
-                    )
-                    continue
-                new.repo = repo
-                pkg_newest(all_pkgs, new)
-                pkg_newest(pkgs[arch], new)
-                prov_newest(provs, new)
+def populate_maintainers(db, all_pkgs, incremental=False):
+    logging.info("Building maintainer table...")
+    counts = collections.Counter(
+        apkvitrine.models.maintainer_name(i.maintainer)
+        for i in all_pkgs.values() if i.maintainer
+    )
+    maints = [
+        apkvitrine.models.Maintainer(None, name, counts[name])
+        for name in sorted(counts)
+    ]
+    # Maintainers of stale packages are pruned with them
+    store_rows(
+        db, apkvitrine.models.Maintainer, maints, lambda i: i.name,
+        incremental, prune=False,
+    )
+    db.commit()
 
-    return all_pkgs, pkgs, provs
+    old_factory = db.row_factory
+    db.row_factory = None
+    rows = db.execute("SELECT name, id FROM maintainers;").fetchall()
+    db.row_factory = old_factory
+    return dict(rows)
+
+def populate_packages(conf, db, all_pkgs, incremental=False):
+    maintainers = populate_maintainers(db, all_pkgs, incremental)
 
-def populate_packages(conf, db, all_pkgs):
     logging.info("Building main package entries...")
     sdir_custom = conf.getmap("startdirs")
 
@@ -112,10 +426,15 @@ def populate_packages(conf, db, all_pkgs):
     mainpkgs = [
         apkvitrine.models.Pkg.from_index(
             i, sdir_custom.get(i.name, f"{i.repo}/{i.name}"), None,
+            maintainers,
         ) for i in all_pkgs.values() if i.origin == i.name
     ]
     main_startdirs = {i.startdir: i.name for i in mainpkgs}
-    apkvitrine.models.Pkg.insertmany(db, mainpkgs)
+    # Stale packages can only be pruned once nothing references them
+    store_rows(
+        db, apkvitrine.models.Pkg, mainpkgs, _pkg_key, incremental,
+        keep=_PKG_KEEP, prune=False,
+    )
     db.commit()
     del mainpkgs
     db.row_factory = apkvitrine.models.Pkg.factory
@@ -130,18 +449,74 @@ def populate_packages(conf, db, all_pkgs):
             continue
         origin = mainpkgs[pkg.origin]
         subpkgs.append(apkvitrine.models.Pkg.from_index(
-            pkg, origin.startdir, origin.id,
+            pkg, origin.startdir, origin.id, maintainers,
         ))
-    apkvitrine.models.Pkg.insertmany(db, subpkgs)
+    store_rows(
+        db, apkvitrine.models.Pkg, subpkgs, _pkg_key, incremental,
+        keep=_PKG_KEEP, prune=False,
+    )
     db.commit()
     del mainpkgs
     del subpkgs
 
     rows = db.execute("SELECT * FROM packages;").fetchall()
-    pkgids = {i.name: i.id for i in rows}
+    pkgids = {i.name: i.id for i in rows if i.name in all_pkgs}
     return pkgids, main_startdirs
 
-def populate_versions(db, all_pkgs, pkgs, pkgids):
+def prune_packages(db, pkgids):
+    keep = set(pkgids.values())
+    old_factory = db.row_factory
+    db.row_factory = None
+    # Subpackages first so that their origins are no longer referenced
+    rows = db.execute("""
+        SELECT id FROM packages ORDER BY origin IS NULL;
+    """).fetchall()
+    db.row_factory = old_factory
+
+    stale = [i for i in rows if i[0] not in keep]
+    db.executemany("DELETE FROM packages WHERE id = ?;", stale)
+    maints = db.execute("""
+        DELETE FROM maintainers WHERE id NOT IN (
+          SELECT maintainer FROM packages WHERE maintainer IS NOT NULL
+        );
+    """).rowcount
+    db.commit()
+    logging.info("packages: %d deleted", len(stale))
+    logging.info("maintainers: %d deleted", maints)
+
+def clear_trackers(db):
+    for table in ("buglinks", "bugs", "mergelinks", "merges"):
+        db.execute(f"DELETE FROM {table};")
+    db.commit()
+
+def finalize_packages(db):
+    # Equivalent to the max_size, pkg_created, pkg_bugged, and pkg_merged
+    # triggers, but also lowers the values when rows have gone away
+    db.execute("""
+        UPDATE packages SET
+        size = (
+          SELECT MAX(size) FROM versions WHERE package = packages.id
+        ),
+        updated = NULLIF(MAX(
+          IFNULL((
+            SELECT MAX(created) FROM versions
+            WHERE package = packages.id
+          ), -1),
+          IFNULL((
+            SELECT MAX(bugs.updated)
+            FROM buglinks INNER JOIN bugs ON bugs.id = buglinks.bug
+            WHERE buglinks.package = packages.id
+          ), -1),
+          IFNULL((
+            SELECT MAX(merges.updated)
+            FROM mergelinks INNER JOIN merges ON merges.id = mergelinks.merge
+            WHERE mergelinks.package = packages.id
+          ), -1)
+        ), -1);
+    """)
+    db.commit()
+
+def populate_versions(db, all_pkgs, pkgs, pkgids, incremental=False):
     logging.info("Building version table...")
 
     vers = collections.defaultdict(list)
@@ -149,7 +524,7 @@ def populate_versions(db, all_pkgs, pkgs, pkgids):
         for pkg in pkgs[arch].values():
             vers[pkg.origin].append(apkvitrine.models.Version(
                 None, pkgids[pkg.name], arch, pkg.version, None,
-                pkg.size, pkg.commit, int(pkg._builddate),
+                pkg.size, pkg.commit, pkg.builddate,
             ))
         missing = set(all_pkgs.keys()) - set(pkgs[arch].keys())
         for name in missing:
@@ -166,18 +541,20 @@ def populate_versions(db, all_pkgs, pkgs, pkgids):
             key=apkvitrine.version.verkey,
             reverse=True,
         )
+        ranks = {ver: i for i, ver in enumerate(cmpvers)}
         for i, ver in enumerate(vers[name]):
             if not ver.version:
                 continue
-            vers[name][i] = ver._replace(
-                vrank=cmpvers.index(ver.version),
-            )
+            vers[name][i] = ver._replace(vrank=ranks[ver.version])
 
     vers = [j for i in vers.values() for j in i]
-    apkvitrine.models.Version.insertmany(db, vers)
+    store_rows(
+        db, apkvitrine.models.Version, vers,
+        lambda i: (i.package, i.arch), incremental,
+    )
     db.commit()
 
-def populate_deps(db, pkgs, pkgids, provs):
+def populate_deps(db, pkgs, pkgids, incremental=False):
     logging.info("Building dependency tables...")
 
     # Common deps
@@ -186,12 +563,15 @@ def populate_deps(db, pkgs, pkgids, provs):
     mdeps = []
 
     for arch in pkgs:
+        # Providers are resolved per architecture, taking versioned
+        # constraints and provider_priority into account
+        providers = apkvitrine.depends.Providers(pkgs[arch].values())
         for name, pkg in pkgs[arch].items():
             odeps = set()
             for dep in pkg.depends:
-                odep = provs.get(atomize(dep))
-                if not odep and dep.startswith("!"):
+                if apkvitrine.depends.parse_spec(dep).conflict:
                     continue
+                odep = providers.resolve(dep)
                 if not odep:
                     logging.warning(
                         "%s/%s depends on unknown %r",
@@ -209,7 +589,7 @@ def populate_deps(db, pkgs, pkgids, provs):
 
                 odeps.add(odep)
 
-            pkg._depends = odeps
+            pkg.depends = odeps
 
             if name not in cdeps:
                 cdeps[pkgids[name]] = odeps
@@ -228,38 +608,98 @@ def populate_deps(db, pkgs, pkgids, provs):
     cdeps = [apkvitrine.models.Dep(i, k) for i, j in cdeps.items() for k in j]
     adeps = [apkvitrine.models.Archdep(i[0], i[1], j) for i in adeps for j in i[2]]
     mdeps = [apkvitrine.models.Missingdep(*i) for i in mdeps]
-    apkvitrine.models.Dep.insertmany(db, cdeps)
-    apkvitrine.models.Archdep.insertmany(db, adeps)
-    apkvitrine.models.Missingdep.insertmany(db, mdeps)
+    store_rows(db, apkvitrine.models.Dep, cdeps, tuple, incremental)
+    store_rows(db, apkvitrine.models.Archdep, adeps, tuple, incremental)
+    store_rows(db, apkvitrine.models.Missingdep, mdeps, tuple, incremental)
     db.commit()
 
-def populate_bugs(conf, db, pkgids, main_startdirs):
+def tracker_store(conf, version, name):
+    if not conf.get("tracker.cache"):
+        return None
+
+    path = conf.getpath("tracker.cache") / version
+    path.mkdir(parents=True, exist_ok=True)
+    return path / f"{name}.json"
+
+def load_store(path, query):
+    if path is None:
+        return {}
+
+    try:
+        store = json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return {}
+    # Anything fetched with different settings has to be fetched again
+    if store.get("query") != query:
+        return {}
+    return store
+
+def save_store(path, query, **kwargs):
+    if path is None:
+        return
+
+    write_atomic(path, json.dumps({"query": query, **kwargs}).encode("utf-8"))
+
+def fetch_bugs(conf, version):
+    field = conf["bz.field"]
+    product = conf["bz.product"]
+    component = conf["bz.component"]
+    status = conf.getlist(
+        "bz.status", ["UNCONFIRMED", "CONFIRMED", "IN_PROGRESS"]
+    )
+    fields = (
+        "id", "status", "summary", "keywords",
+        field, "last_change_time", "product", "component",
+    )
+    query = [
+        ("include_fields", ",".join(fields)),
+    ]
+
+    path = tracker_store(conf, version, "bugs")
+    store_query = [conf["bz.api"], field, product, component, status]
+    store = load_store(path, store_query)
+    items = store.get("bugs", {})
+    stamp = store.get("stamp")
+
+    if stamp:
+        # Only ask for bugs that changed since the newest one already
+        # seen, whatever their product, component, or status now is, so
+        # that bugs which left the query can be dropped
+        query.append(("last_change_time", stamp))
+    else:
+        query.extend((
+            ("product", product),
+            ("component", component),
+            ("status", status),
+        ))
+
+    client = apkvitrine.client.JSONClient(conf["bz.api"])
+    query = urllib.parse.urlencode(query, doseq=True)
+    bz_bugs = client.get(f"bug?{query}")["bugs"]
+    logging.info(
+        "Fetched %d %s bugs", len(bz_bugs), "changed" if stamp else "open",
+    )
+
+    status = set(status)
+    for bug in bz_bugs:
+        stamp = max(stamp or "", bug["last_change_time"])
+        if bug["product"] == product and bug["component"] == component \
+                and (not status or bug["status"] in status):
+            items[str(bug["id"])] = bug
+        else:
+            items.pop(str(bug["id"]), None)
+
+    save_store(path, store_query, stamp=stamp, bugs=items)
+    return sorted(items.values(), key=lambda bug: bug["id"])
+
+def populate_bugs(conf, db, pkgids, main_startdirs, version):
     # TODO: match on version
     if not conf.get("bz.api"):
         return
 
     logging.info("Building bug tables...")
     field = conf["bz.field"]
-    query = urllib.parse.urlencode([
-        ("product", conf["bz.product"]),
-        ("component", conf["bz.component"]),
-        ("include_fields", ",".join((
-            "id", "status", "summary", "keywords",
-            field, "last_change_time",
-        ))),
-        ("status", conf.getlist(
-            "bz.status", ["UNCONFIRMED", "CONFIRMED", "IN_PROGRESS"]
-        )),
-    ], doseq=True)
-    request = urllib.request.Request(
-        url=f"{conf['bz.api']}/bug?{query}",
-        method="GET",
-        headers={
-            "Accept": "application/json",
-        },
-    )
-    with urllib.request.urlopen(request) as response:
-        bz_bugs = json.load(response)["bugs"]
+    bz_bugs = fetch_bugs(conf, version)
 
     bugs = []
     buglinks = []
@@ -308,35 +748,74 @@ def populate_bugs(conf, db, pkgids, main_startdirs):
     apkvitrine.models.Buglink.insertmany(db, buglinks)
     db.commit()
 
-def populate_merges(conf, db, pkgids, main_startdirs):
-    if not conf.get("gl.api"):
-        return
+def merge_startdirs(changes):
+    sdirs = set()
+    for change in changes:
+        for path in (change["old_path"], change["new_path"]):
+            path = path.split("/", maxsplit=2)
+            if len(path) != 3 or path[2] != "APKBUILD":
+                continue
+            repo, pkg, _ = path
+            sdirs.add((repo, pkg))
+    return sorted(sdirs)
 
-    logging.info("Building merge request tables...")
+def fetch_merges(conf, version):
     query = urllib.parse.urlencode({
         "state": "opened",
         "target_branch": conf["gl.branch"],
     }, doseq=True)
-    url = f"{conf['gl.api']}/merge_requests?{query}"
-    with urllib.request.urlopen(url) as response:
-        gl_merges = json.load(response)
+    client = apkvitrine.client.JSONClient(conf["gl.api"])
+    gl_merges = client.get_pages(f"merge_requests?{query}")
+
+    path = tracker_store(conf, version, "merges")
+    store_query = [conf["gl.api"], conf["gl.branch"]]
+    seen = load_store(path, store_query).get("merges", {})
+
+    # The list of open merge requests is always fetched in full, but the
+    # changes of a merge request are only fetched again when it has been
+    # updated
+    items = {}
+    stale = []
+    for merge in gl_merges:
+        old = seen.get(str(merge["iid"]))
+        if old and old["updated_at"] == merge["updated_at"]:
+            items[str(merge["iid"])] = old
+        else:
+            stale.append(merge)
+    logging.info(
+        "Fetching changes of %d/%d merge requests",
+        len(stale), len(gl_merges),
+    )
+
+    workers = conf.getint("gl.connections")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        all_changes = pool.map(
+            lambda merge: client.get(
+                f"merge_requests/{merge['iid']}/changes",
+            )["changes"],
+            stale,
+        )
+        for merge, gl_changes in zip(stale, all_changes):
+            items[str(merge["iid"])] = {
+                "updated_at": merge["updated_at"],
+                "sdirs": merge_startdirs(gl_changes),
+            }
+
+    save_store(path, store_query, merges=items)
+    return [
+        (merge, items[str(merge["iid"])]["sdirs"]) for merge in gl_merges
+    ]
+
+def populate_merges(conf, db, pkgids, main_startdirs, version):
+    if not conf.get("gl.api"):
+        return
+
+    logging.info("Building merge request tables...")
+    gl_merges = fetch_merges(conf, version)
 
     merges = []
     mergelinks = []
-    for merge in gl_merges:
-        url = f"{conf['gl.api']}/merge_requests/{merge['iid']}/changes"
-        with urllib.request.urlopen(url) as response:
-            gl_changes = json.load(response)["changes"]
-
-        sdirs = set()
-        for change in gl_changes:
-            for path in (change["old_path"], change["new_path"]):
-                path = path.split("/", maxsplit=2)
-                if len(path) != 3 or path[2] != "APKBUILD":
-                    continue
-                repo, pkg, _ = path
-                sdirs.add((repo, pkg))
-
+    for merge, sdirs in gl_merges:
         matches = False
         for repo, pkg in sdirs:
             sdir = f"{repo}/{pkg}"
@@ -369,6 +848,129 @@ def populate_merges(conf, db, pkgids, main_startdirs):
     apkvitrine.models.Mergelink.insertmany(db, mergelinks)
     db.commit()
 
+def build(opts, version):
+    logging.info("Building %s database...", version)
+    conf = apkvitrine.config(version)
+    apkvitrine.version.cache_clear()
+    apkvitrine.stats.reset()
+    report = apkvitrine.stats.start(version)
+    phase = apkvitrine.stats.phase
+    name = opts.dir / f"{version}.sqlite"
+    db, incremental = init_db(name, opts.incremental, opts.bulk)
+
+    try:
+        with phase(report, "indices"):
+            all_pkgs, pkgs = pull_indices(conf, version, opts.jobs)
+
+        with phase(report, "packages", db):
+            pkgids, main_startdirs = populate_packages(
+                conf, db, all_pkgs, incremental,
+            )
+        with phase(report, "versions", db):
+            populate_versions(db, all_pkgs, pkgs, pkgids, incremental)
+            del all_pkgs
+        with phase(report, "deps", db):
+            populate_deps(db, pkgs, pkgids, incremental)
+
+        if incremental:
+            with phase(report, "prune", db):
+                clear_trackers(db)
+                prune_packages(db, pkgids)
+        with phase(report, "outdated", db):
+            summarize_versions(db)
+        with phase(report, "bugs", db):
+            populate_bugs(conf, db, pkgids, main_startdirs, version)
+        with phase(report, "merges", db):
+            populate_merges(conf, db, pkgids, main_startdirs, version)
+        with phase(report, "search", db):
+            index_search(db)
+        with phase(report, "counts", db):
+            count_packages(db)
+        report["tables"] = apkvitrine.stats.tables(db)
+        with phase(report, "finish"):
+            if incremental:
+                finalize_packages(db)
+            finish_db(db, name, incremental, opts.bulk)
+    except BaseException:
+        # Closing the database without committing rolls back an
+        # incremental update
+        db.close()
+        raise
+    log_cache_info()
+
+    report = apkvitrine.stats.finish(report)
+    write_atomic(
+        opts.dir / f"{version}.report.json",
+        json.dumps(report, indent=2).encode("utf-8"),
+    )
+
+def setup_logging(opts, version=None):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+
+    fmt = logging.BASIC_FORMAT
+    handlers = [logging.StreamHandler()]
+    if version:
+        fmt = f"%(levelname)s:{version}:%(message)s"
+        if opts.logdir:
+            handlers.append(logging.FileHandler(
+                str(opts.logdir / f"{version}.log"), mode="w",
+            ))
+
+    for handler in handlers:
+        handler.setFormatter(logging.Formatter(fmt))
+        root.addHandler(handler)
+    root.setLevel(opts.loglevel)
+
+def build_logged(opts, version):
+    setup_logging(opts, version)
+    try:
+        build(opts, version)
+    except Exception: # pylint: disable=broad-except
+        logging.exception("Failed to build %s database", version)
+        # Left behind by a full rebuild, even in incremental mode
+        try:
+            temp_name(opts.dir / f"{version}.sqlite").unlink()
+        except FileNotFoundError:
+            pass
+        return False
+    return True
+
+def build_all(opts):
+    results = {}
+    if opts.processes > 1 and len(opts.versions) > 1:
+        pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=opts.processes,
+        )
+        with pool:
+            futures = {
+                pool.submit(build_logged, opts, version): version
+                for version in opts.versions
+            }
+            for future in concurrent.futures.as_completed(futures):
+                version = futures[future]
+                try:
+                    results[version] = future.result()
+                except Exception: # pylint: disable=broad-except
+                    # e.g. the worker process was killed
+                    logging.exception("Failed to build %s database", version)
+                    results[version] = False
+    else:
+        for version in opts.versions:
+            results[version] = build_logged(opts, version)
+    setup_logging(opts)
+
+    built = [i for i in opts.versions if results[i]]
+    failed = [i for i in opts.versions if not results[i]]
+    if built:
+        logging.info("Built: %s", ", ".join(built))
+    if failed:
+        logging.error("Failed: %s", ", ".join(failed))
+
+    return not failed
+
 if __name__ == "__main__":
     opts = argparse.ArgumentParser(
         usage="python3 -m apkvitrine.build_db [options ...] VERSION [VERSION ...]",
@@ -377,6 +979,29 @@ if __name__ == "__main__":
         "-d", "--output-directory", dest="dir",
         help="directory in which to write complete databases",
     )
+    opts.add_argument(
+        "-j", "--jobs", dest="jobs", type=int, default=1,
+        help="number of APKINDEX files to download at once (they are"
+        " parsed one at a time)",
+    )
+    mode = opts.add_mutually_exclusive_group()
+    mode.add_argument(
+        "-i", "--incremental", action="store_true",
+        help="update existing databases in place, keeping row IDs stable",
+    )
+    mode.add_argument(
+        "-b", "--bulk", action="store_true",
+        help="build into a temporary file with relaxed durability, then"
+        " optimize it and rename it over the existing database",
+    )
+    opts.add_argument(
+        "-P", "--processes", type=int, default=1,
+        help="number of versions to build at once, each in its own process",
+    )
+    opts.add_argument(
+        "-l", "--log-directory", dest="logdir",
+        help="directory in which to write a log file for each version",
+    )
     opts.add_argument(
         "-q", "--quiet", dest="loglevel",
         action="store_const", const="WARNING", default="INFO",
@@ -388,21 +1013,10 @@ if __name__ == "__main__":
     )
     opts = opts.parse_args()
     opts.dir = Path(opts.dir).resolve() if opts.dir else Path.cwd()
-    logging.basicConfig(level=opts.loglevel)
-
-    for version in opts.versions:
-        logging.info("Building %s database...", version)
-        conf = apkvitrine.config(version)
-        repos = conf.getmaplist("repos")
-        db = init_db(opts.dir / f"{version}.sqlite")
-
-        all_pkgs, pkgs, provs = pull_indices(conf, version)
+    opts.logdir = Path(opts.logdir).resolve() if opts.logdir else None
 
-        pkgids, main_startdirs = populate_packages(conf, db, all_pkgs)
-        populate_versions(db, all_pkgs, pkgs, pkgids)
-        del all_pkgs
-        populate_deps(db, pkgs, pkgids, provs)
-        del provs
+    if opts.logdir:
+        opts.logdir.mkdir(parents=True, exist_ok=True)
+    setup_logging(opts)
 
-        populate_bugs(conf, db, pkgids, main_startdirs)
-        populate_merges(conf, db, pkgids, main_startdirs)
+    sys.exit(0 if build_all(opts) else 1)
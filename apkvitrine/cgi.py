@@ -2,20 +2,28 @@
 # Copyright (c) 2020 Max Rees
 # See LICENSE for more information.
 import datetime     # datetime, timezone
+import email.utils  # formatdate, parsedate_to_datetime
+import hashlib      # blake2b
 import http         # HTTPStatus
-import json         # load
+import json         # dumps, load
 import sqlite3      # connect, OperationalError
+import threading    # local
 import time         # time
 import urllib.parse # parse_qs, urlencode
 import urllib.request # Request, urlopen
 from pathlib import Path
 
-import flup.server.fcgi as flup # WSGIServer
+import flup.server.fcgi      # WSGIServer
+import flup.server.fcgi_fork # WSGIServer
 import jinja2 # Environment, FileSystemBytecodeCache, Markup, PackageLoader
               # environmentfilter
 
 import apkvitrine        # BUILDERS, config, DEFAULT
-import apkvitrine.models # build_search, Pkg
+import apkvitrine.models # build_branch, build_search, get_count,
+                         # get_maintainers, has_search_index,
+                         # load_related, paginate, Pkg
+import apkvitrine.pagecache # ENCODINGS, generation, generation_time,
+                            # MemoryCache, PageCache, variants
 
 @jinja2.environmentfilter
 def datetime_filter(env, timestamp):
@@ -34,39 +42,60 @@ def datetime_filter(env, timestamp):
         result = f"<span class='datetime' title='{full}'>{rel}</span>"
     return jinja2.Markup(result)
 
+# Page cache of each database connection, in KiB
+DB_CACHE_SIZE = 16384
+
 def init_db(app, branch):
     if "/" in branch:
         raise ValueError("branch may not contain '/'")
     db = app.data / f"{branch}.sqlite"
     if not db.is_file():
         return None
+
+    # Connections are kept open between requests, one per thread since
+    # they cannot be shared, and reopened once the database has been
+    # replaced or updated in place
+    stat = db.stat()
+    key = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+    conns = getattr(app.dbs, "conns", None)
+    if conns is None:
+        conns = app.dbs.conns = {}
+    if branch in conns:
+        old_key, conn = conns[branch]
+        if old_key == key:
+            # In case a failed request left it behind
+            conn.row_factory = None
+            return conn
+        del conns[branch]
+        conn.close()
+
     try:
-        return sqlite3.connect(str(db))
+        # Not immutable, since incremental builds write to the database
+        # while it is being read
+        conn = sqlite3.connect(f"{db.resolve().as_uri()}?mode=ro", uri=True)
+        conn.execute(f"PRAGMA mmap_size = {app.mmap_size};")
+        conn.execute(f"PRAGMA cache_size = -{DB_CACHE_SIZE};")
     except sqlite3.OperationalError:
         return None
+    conns[branch] = (key, conn)
+    return conn
 
-def pkg_paginate(conf, query, db, sql):
-    query["limit"] = conf.getint("web.pagination")
-    try:
-        query["page"] = int(query.get("page", "1"))
-    except ValueError:
-        query["page"] = 1
-    sql_count = f"SELECT COUNT(*) FROM ({sql})"
-    query["offset"] = (query["page"] - 1) * query["limit"]
-    query["total"] = db.execute(sql_count, query).fetchone()[0]
-
-    db.row_factory = apkvitrine.models.Pkg.factory
-    sql += " LIMIT :limit OFFSET :offset"
-    return db.execute(sql, query).fetchall()
+def pkg_paginate(conf, query, db, sql, total=None):
+    return apkvitrine.models.paginate(
+        db, sql, query, conf.getint("web.pagination"), total,
+    )
 
 def pkg_versions(conf, db, pkgs):
     versions = {}
     repos = set()
     arches = set()
 
+    related = apkvitrine.models.load_related(
+        db, [pkg.id for pkg in pkgs], ("versions",),
+    )
     for pkg in pkgs:
         repos.add(pkg.repo)
-        versions[pkg.name] = pkg.get_versions(db)
+        versions[pkg.name] = related[pkg.id].versions
     for repo in repos:
         arches.update(conf.getmaplist("repos")[repo])
 
@@ -81,12 +110,12 @@ def gl_runner_info(token, endpoint, api):
     with urllib.request.urlopen(request) as response:
         return json.load(response)
 
-def page_builders(app):
-    if apkvitrine.BUILDERS not in app.conf:
-        return app.notfound()
-    bconf = app.conf[apkvitrine.BUILDERS]
+def page_builders(req):
+    if apkvitrine.BUILDERS not in req.app.conf:
+        return req.notfound()
+    bconf = req.app.conf[apkvitrine.BUILDERS]
     if not bconf.get("gl.token") or not bconf.get("gl.api"):
-        return app.notfound()
+        return req.notfound()
 
     token = bconf["gl.token"]
     api = bconf["gl.api"]
@@ -119,93 +148,94 @@ def page_builders(app):
         if jobs:
             builders[i].fail_job = apkvitrine.models.Job(jobs[0])
 
-    app.ok()
-    page = app.jinja.get_template("builders.tmpl").render(
-        conf=app.conf[apkvitrine.DEFAULT],
+    req.ok()
+    page = req.render(
+        "builders.tmpl",
+        conf=req.app.conf[apkvitrine.DEFAULT],
         builders=builders,
-        cached=time.time() if app.cache else None,
-    ).encode("utf-8")
-    app.save_cache(page)
+        cached=time.time() if req.app.cache or req.app.memcache else None,
+    )
+    req.save_cache(page)
     return [page]
 
-def page_branches(app):
-    branches = list(app.conf.sections())
+def page_branches(req):
+    branches = list(req.app.conf.sections())
     show_builders = apkvitrine.BUILDERS in branches
 
     for i, branch in enumerate(branches):
-        if not (app.data / f"{branch}.sqlite").is_file():
+        if not (req.app.data / f"{branch}.sqlite").is_file():
             branches[i] = None
 
     branches = [i for i in branches if i]
-    app.ok()
-    page = app.jinja.get_template("branches.tmpl").render(
-        conf=app.conf[apkvitrine.DEFAULT],
+    req.ok()
+    page = req.render(
+        "branches.tmpl",
+        conf=req.app.conf[apkvitrine.DEFAULT],
         branches=branches,
         show_builders=show_builders,
-    ).encode("utf-8")
-    app.save_cache(page)
+    )
+    req.save_cache(page)
     return [page]
 
-def page_branch(app):
-    branch = app.path.parts[0]
-    db = init_db(app, branch)
-    if not db or branch not in app.conf:
-        return app.notfound()
-    conf = app.conf[branch]
-
-    pkgs = pkg_paginate(conf, app.query, db, """
-        SELECT * FROM packages
-        WHERE origin IS NULL
-        ORDER BY updated DESC
-    """)
-    app.ok()
+def page_branch(req):
+    branch = req.path.parts[0]
+    db = init_db(req.app, branch)
+    if not db or branch not in req.app.conf:
+        return req.notfound()
+    conf = req.app.conf[branch]
+
+    pkgs = pkg_paginate(
+        conf, req.query, db, apkvitrine.models.build_branch(req.query),
+        apkvitrine.models.get_count(db, "packages"),
+    )
+    req.ok()
     versions, repos, arches = pkg_versions(conf, db, pkgs)
 
-    page = app.jinja.get_template("branch.tmpl").render(
+    page = req.render(
+        "branch.tmpl",
         conf=conf,
         branch=branch,
-        query=app.query,
+        query=req.query,
         repos=repos,
         arches=arches,
         pkgs=pkgs,
         versions=versions,
-    ).encode("utf-8")
-    app.save_cache(page)
+    )
+    req.save_cache(page)
     return [page]
 
-def page_package(app):
-    branch, name = app.path.parts
-    db = init_db(app, branch)
-    if not db or branch not in app.conf:
-        return app.notfound()
-    conf = app.conf[branch]
-
-    db.row_factory = apkvitrine.models.Pkg.factory
-    pkg = db.execute("""
-        SELECT * FROM packages WHERE name = ?;
-    """, (name,)).fetchone()
+def page_package(req):
+    branch, name = req.path.parts
+    db = init_db(req.app, branch)
+    if not db or branch not in req.app.conf:
+        return req.notfound()
+    conf = req.app.conf[branch]
+
+    pkg = apkvitrine.models.Pkg.get_by_name(db, name)
     if not pkg:
-        return app.notfound()
+        return req.notfound()
 
     pkg = pkg._replace(origin=pkg.get_origin(db))
     if pkg.maintainer:
-        pkg = pkg._replace(maintainer=pkg.maintainer.split(" <")[0])
+        pkg = pkg._replace(maintainer=pkg.get_maintainer(db).name)
     subpkgs = pkg.get_subpkgs(db)
+    related = apkvitrine.models.load_related(db, [pkg.id])[pkg.id]
 
-    app.ok()
-    page = app.jinja.get_template("package.tmpl").render(
+    req.ok()
+    page = req.render(
+        "package.tmpl",
         conf=conf,
         branch=branch,
-        versions=pkg.get_versions(db),
+        versions=related.versions,
         arches=sorted(conf.getmaplist("repos")[pkg.repo]),
         pkg=pkg,
-        deps=pkg.get_deps(db),
-        rdeps=pkg.get_deps(db, reverse=True),
+        deps=related.deps,
+        rdeps=related.rdeps,
         subpkgs=subpkgs,
-        bugs=pkg.get_bugs(db),
-        merges=pkg.get_merges(db),
-    ).encode("utf-8")
-    app.save_cache(page)
+        bugs=related.bugs,
+        merges=related.merges,
+    )
+    req.save_cache(page)
     return [page]
 
 # Don't consider it a complete search if only some combination of the
@@ -213,6 +243,7 @@ def page_package(app):
 _BORING_TOGGLES = (
     "simple",
     "page",
+    "after",
     "cs",
     "subpkgs",
     "availability",
@@ -220,122 +251,102 @@ _BORING_TOGGLES = (
     "purge",
 )
 
-def page_search(app):
-    branch = app.path.parts[0]
-    db = init_db(app, branch)
-    if not db or branch not in app.conf:
-        return app.notfound()
-    conf = app.conf[branch]
-
-    maints = set(db.execute("""
-        SELECT DISTINCT(maintainer) FROM packages
-        ORDER BY maintainer;
-    """).fetchall())
-    have_none = False
-    if (None,) in maints:
-        have_none = True
-        maints.remove((None,))
-    maints = sorted({j.split(" <")[0] for i in maints for j in i})
-    if have_none:
-        maints.insert(0, "None")
-
-    app.ok()
-
-    if any([j for i, j in app.query.items() if i not in _BORING_TOGGLES]):
+def page_search(req):
+    branch = req.path.parts[0]
+    db = init_db(req.app, branch)
+    if not db or branch not in req.app.conf:
+        return req.notfound()
+    conf = req.app.conf[branch]
+
+    maints = apkvitrine.models.get_maintainers(db)
+
+    req.ok()
+
+    if any([j for i, j in req.query.items() if i not in _BORING_TOGGLES]):
         searched = True
-        new_query = app.query.copy()
-        sql = apkvitrine.models.build_search(new_query)
+        new_query = req.query.copy()
+        sql = apkvitrine.models.build_search(
+            new_query, apkvitrine.models.has_search_index(db),
+        )
         pkgs = pkg_paginate(conf, new_query, db, sql)
-        app.query["limit"] = new_query["limit"]
-        app.query["offset"] = new_query["offset"]
-        app.query["total"] = new_query["total"]
-        app.query["page"] = new_query["page"]
+        for i in ("limit", "offset", "total", "page", "estimate", "more", "next"):
+            req.query[i] = new_query[i]
     else:
         searched = False
         pkgs = []
 
-    if app.query.get("availability"):
+    if req.query.get("availability"):
         versions, repos, arches = pkg_versions(conf, db, pkgs)
     else:
         versions = {}
         repos = []
         arches = []
 
-    page = app.jinja.get_template("search.tmpl").render(
+    page = req.render(
+        "search.tmpl",
         conf=conf,
         branch=branch,
-        query=app.query,
+        query=req.query,
         maints=maints,
         searched=searched,
         repos=repos,
         arches=arches,
         pkgs=pkgs,
         versions=versions,
-    ).encode("utf-8")
-    if not searched:
-        app.save_cache(page)
+    )
+    req.save_cache(page)
     return [page]
 
-def page_home(app):
-    return app.redirect(app.conf[apkvitrine.DEFAULT]["cgi.default_version"])
-
-def page_notfound(app):
-    return app.notfound()
-
-class APKVitrineApp: # pylint: disable=too-many-instance-attributes
-    routes = {
-        "-/versions": page_branches,
-        "-/builders": page_builders,
-        "*/-/search": page_search,
-        "*/*/*": page_notfound,
-        "*/*": page_package,
-        "*": page_branch,
-        ".": page_home,
-    }
-
+def page_cache(req):
+    if not req.app.memcache:
+        return req.notfound()
+    # For this process only
+    req.ok(ctype="application/json")
+    return [json.dumps(req.app.memcache.stats()).encode("utf-8")]
+
+def page_home(req):
+    return req.redirect(req.app.conf[apkvitrine.DEFAULT]["cgi.default_version"])
+
+def page_notfound(req):
+    return req.notfound()
+
+def accepted_encoding(header):
+    # The first of the content codings in which pages are stored that
+    # the client accepts, or None for the page itself
+    for item in header.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if coding not in apkvitrine.pagecache.ENCODINGS:
+            continue
+        params = params.replace(" ", "")
+        if params.startswith("q=") and not params[2:].strip("0."):
+            continue
+        return coding
+    return None
+
+class Request: # pylint: disable=too-many-instance-attributes
+    # Everything that belongs to a single request, so that concurrent
+    # requests on different threads do not share any state except the
+    # application itself
     __slots__ = (
         "_response",
+        "app",
         "base",
-        "cache",
         "cacheable",
-        "conf",
-        "data",
+        "encoding",
         "env",
-        "jinja",
+        "generation",
+        "headers",
+        "key",
         "path",
         "query",
+        "request",
+        "status",
+        "variants",
     )
 
-    def __init__(self):
-        self.jinja = jinja2.Environment(
-            loader=jinja2.PackageLoader("apkvitrine", "data"),
-            autoescape=True,
-            trim_blocks=True,
-            bytecode_cache=jinja2.FileSystemBytecodeCache(),
-            extensions=["jinja2.ext.loopcontrols"],
-            line_statement_prefix="#",
-            line_comment_prefix="##",
-        )
-        self.jinja.filters["datetime"] = datetime_filter
-
-        self.conf = apkvitrine.config()
-
-        if self.conf[apkvitrine.DEFAULT].get("cgi.cache"):
-            self.cache = Path(self.conf[apkvitrine.DEFAULT]["cgi.cache"])
-        else:
-            self.cache = None
-        self.jinja.globals["cache"] = bool(self.cache)
-
-        self.data = Path(self.conf[apkvitrine.DEFAULT]["cgi.data"])
-
-        self._response = self.env = None
-        self.base = self.path = self.query = None
-
-    def get_host(self):
-        host = self.env.get("HTTP_HOST", "")
-        return f"//{host}/" if host else ""
-
-    def handle(self, env, response):
+    def __init__(self, app, env, response):
+        self.app = app
         self.env = env
         self._response = response
 
@@ -345,71 +356,182 @@ class APKVitrineApp: # pylint: disable=too-many-instance-attributes
         self.query = urllib.parse.parse_qs(env.get("QUERY_STRING", ""))
         self.query = {i: j[-1] for i, j in self.query.items()}
         self.cacheable = False if self.query else True
-
-        self.jinja.globals["base"] = self.base
-        # Used for pagination on search pages so that "page=x" isn't repeated
-        self.jinja.globals["request"] = self.base + str(self.path) + "?"
-        self.jinja.globals["request"] += urllib.parse.urlencode(
-            {i: j for i, j in self.query.items() if i != "page"}
+        self.encoding = accepted_encoding(env.get("HTTP_ACCEPT_ENCODING", ""))
+        # Set by cached_page() if a cache is enabled
+        self.generation = self.key = None
+
+        # Sent by finish() once the page is known
+        self.status = self.headers = None
+        # The page in each content coding that it is available in, if
+        # it can be cached
+        self.variants = None
+
+        # Used for pagination on search pages so that "page=x" and
+        # "after=x" aren't repeated
+        self.request = self.base + str(self.path) + "?"
+        self.request += urllib.parse.urlencode(
+            {i: j for i, j in self.query.items() if i not in ("page", "after")}
         )
 
-        page = self.cached_page()
-        if page is not None:
-            return page
-
-        return self.generate_page()
+    def get_host(self):
+        host = self.env.get("HTTP_HOST", "")
+        return f"//{host}/" if host else ""
 
-    def cache_name(self, path):
-        return self.cache / path.parent / (path.name + ".html")
+    def render(self, template, **kwargs):
+        return self.app.jinja.get_template(template).render(
+            base=self.base,
+            request=self.request,
+            **kwargs,
+        ).encode("utf-8")
+
+    def cache_generation(self):
+        # Pages of a branch are cached until its database changes, and
+        # the other pages until any database is added or replaced
+        branch = self.path.parts[0] if self.path.parts else "-"
+        try:
+            return branch, apkvitrine.pagecache.generation(
+                self.app.data / f"{branch}.sqlite",
+            )
+        except FileNotFoundError:
+            return "-", apkvitrine.pagecache.generation(self.app.data)
+
+    def memcache_key(self, query):
+        query = tuple(sorted(
+            (i, j) for i, j in query.items() if i != "purge"
+        ))
+        return (*self.generation, str(self.path), query)
 
     def save_cache(self, page, path=None):
-        if not self.cache or not self.cacheable:
+        if not (self.app.cache or self.app.memcache):
+            return
+        variants = apkvitrine.pagecache.variants(page)
+        if not path:
+            self.variants = variants
+            if self.app.memcache:
+                for encoding, variant in variants.items():
+                    self.app.memcache.put(self.key + (encoding,), variant)
+
+        if not self.app.cache or not self.cacheable:
             return
         if not path:
             path = self.path
 
-        cache = self.cache_name(path)
-        cache.parent.mkdir(parents=True, exist_ok=True)
-        cache.write_bytes(page)
+        for encoding, variant in variants.items():
+            self.app.cache.put(*self.generation, path, variant, encoding)
+
+    def purge(self):
+        # The page without a query is thrown out of the caches, but at
+        # most every ten minutes
+        key = self.memcache_key({})
+        ages = []
+        if self.app.memcache:
+            ages.append(self.app.memcache.age(key + (None,)))
+        if self.app.cache:
+            ages.append(self.app.cache.age(*self.generation, self.path))
+        ages = [i for i in ages if i is not None]
+        if not ages:
+            return None
+
+        if min(ages) > 600:
+            if self.app.memcache:
+                for encoding in apkvitrine.pagecache.ENCODINGS:
+                    self.app.memcache.pop(key + (encoding,))
+            if self.app.cache:
+                self.app.cache.remove(*self.generation, self.path)
+        return self.redirect(self.path)
 
     def cached_page(self):
-        if not self.cache:
+        if not (self.app.cache or self.app.memcache) \
+                or ".." in self.path.parts:
             return None
 
-        cache = self.cache_name(self.path)
-        if cache.exists():
-            if not self.query:
-                self.ok()
-                return [cache.read_bytes()]
-            if self.query.get("purge") == "1":
-                if (time.time() - cache.stat().st_mtime) > 600:
-                    cache.unlink()
-                return self.redirect(self.path)
-
-        return None
+        # Determined before the database is read, so that a page
+        # rendered while the database is replaced is never used again
+        self.generation = self.cache_generation()
+        # Also before the handler adds its own entries to the query
+        self.key = self.memcache_key(self.query)
+        if self.query.get("purge") == "1":
+            return self.purge()
+
+        page = None
+        if self.app.memcache:
+            page = self.app.memcache.get(self.key + (self.encoding,))
+
+        if page is None and self.app.cache and not self.query:
+            page = self.app.cache.get(
+                *self.generation, self.path, self.encoding,
+            )
+            if page is not None and self.app.memcache:
+                self.app.memcache.put(self.key + (self.encoding,), page)
+
+        if page is None:
+            return None
+        self.variants = {self.encoding: page}
+        self.ok()
+        return [page]
+
+    def validate(self):
+        # Called for cached pages only. Returns the page in the content
+        # coding that the client asked for, or None if the client's copy
+        # is still fresh.
+        encoding = self.encoding if self.encoding in self.variants else None
+        page = self.variants[encoding]
+        etag = hashlib.blake2b(page, digest_size=8).hexdigest()
+        etag = f'"{self.generation[1]}-{etag}"'
+        modified = int(apkvitrine.pagecache.generation_time(self.generation[1]))
+        max_age = self.app.conf[apkvitrine.DEFAULT].getint("cgi.max_age")
+
+        self.headers += [
+            ("ETag", etag),
+            ("Last-Modified", email.utils.formatdate(modified, usegmt=True)),
+            ("Cache-Control", f"max-age={max_age}" if max_age else "no-cache"),
+            ("Vary", "Accept-Encoding"),
+        ]
+
+        fresh = False
+        if "HTTP_IF_NONE_MATCH" in self.env:
+            tags = [i.strip() for i in self.env["HTTP_IF_NONE_MATCH"].split(",")]
+            # Weak comparison, since proxies may weaken the tag
+            tags = [i[2:] if i.startswith("W/") else i for i in tags]
+            fresh = etag in tags or "*" in tags
+        elif "HTTP_IF_MODIFIED_SINCE" in self.env:
+            try:
+                since = email.utils.parsedate_to_datetime(
+                    self.env["HTTP_IF_MODIFIED_SINCE"],
+                )
+                fresh = modified <= since.timestamp()
+            except (TypeError, ValueError):
+                pass
+        if fresh:
+            self.status = http.HTTPStatus.NOT_MODIFIED
+            self.headers = [
+                i for i in self.headers if i[0].lower() != "content-type"
+            ]
+            return None
 
-    def generate_page(self):
-        if ".." in self.path.parts:
-            return self.badreq()
+        if encoding:
+            self.headers.append(("Content-Encoding", encoding))
+        self.headers.append(("Content-Length", str(len(page))))
+        return page
 
-        for route, handler in self.routes.items():
-            if route == ".":
-                if route == str(self.path):
-                    return handler(self)
-            elif self.path.match(route):
-                return handler(self)
-        return self.notfound()
+    def finish(self, page):
+        if self.status == http.HTTPStatus.OK and self.variants:
+            page = self.validate()
+            page = [] if page is None else [page]
+        self._response(f"{self.status.value} {self.status.phrase}", self.headers)
+        return page
 
     def response(self, status, *, ctype=None, headers=None):
         if not headers:
             headers = []
         if ctype or "content-type" not in [i[0].lower() for i in headers]:
             headers.append(("Content-Type", ctype or "text/html; charset=utf-8"))
-        self._response(f"{status.value} {status.phrase}", headers)
+        self.status = status
+        self.headers = headers
 
     def error(self, status, **kwargs):
         self.response(status, ctype="text/plain", **kwargs)
-        return [f"Error {status.value} - {status.phrase}"]
+        return [f"Error {status.value} - {status.phrase}".encode("utf-8")]
 
     def notfound(self, **kwargs):
         return self.error(http.HTTPStatus.NOT_FOUND, **kwargs)
@@ -427,9 +549,109 @@ class APKVitrineApp: # pylint: disable=too-many-instance-attributes
         )
         return []
 
+class APKVitrineApp:
+    routes = {
+        "-/versions": page_branches,
+        "-/builders": page_builders,
+        "-/cache": page_cache,
+        "*/-/search": page_search,
+        "*/*/*": page_notfound,
+        "*/*": page_package,
+        "*": page_branch,
+        ".": page_home,
+    }
+
+    # Nothing here may change once the application has been set up,
+    # except for the per-thread database connections
+    __slots__ = (
+        "cache",
+        "conf",
+        "data",
+        "dbs",
+        "jinja",
+        "memcache",
+        "mmap_size",
+    )
+
+    def __init__(self):
+        self.jinja = jinja2.Environment(
+            loader=jinja2.PackageLoader("apkvitrine", "data"),
+            autoescape=True,
+            trim_blocks=True,
+            bytecode_cache=jinja2.FileSystemBytecodeCache(),
+            extensions=["jinja2.ext.loopcontrols"],
+            line_statement_prefix="#",
+            line_comment_prefix="##",
+        )
+        self.jinja.filters["datetime"] = datetime_filter
+
+        self.conf = apkvitrine.config()
+
+        if self.conf[apkvitrine.DEFAULT].get("cgi.cache"):
+            self.cache = apkvitrine.pagecache.PageCache(
+                self.conf[apkvitrine.DEFAULT]["cgi.cache"],
+                self.conf[apkvitrine.DEFAULT].getint("cgi.cache_size"),
+                self.conf[apkvitrine.DEFAULT].getint("cgi.cache_entries"),
+            )
+        else:
+            self.cache = None
+        if self.conf[apkvitrine.DEFAULT].getint("cgi.memory_cache"):
+            self.memcache = apkvitrine.pagecache.MemoryCache(
+                self.conf[apkvitrine.DEFAULT].getint("cgi.memory_cache"),
+            )
+        else:
+            self.memcache = None
+        # Relative times would go stale in cached pages
+        self.jinja.globals["cache"] = bool(self.cache or self.memcache)
+
+        self.data = Path(self.conf[apkvitrine.DEFAULT]["cgi.data"])
+        self.mmap_size = self.conf[apkvitrine.DEFAULT].getint("cgi.mmap_size")
+        self.dbs = threading.local()
+
+    def handle(self, env, response):
+        req = Request(self, env, response)
+
+        page = req.cached_page()
+        if page is None:
+            page = self.generate_page(req)
+        return req.finish(page)
+
+    def generate_page(self, req):
+        if ".." in req.path.parts:
+            return req.badreq()
+
+        for route, handler in self.routes.items():
+            if route == ".":
+                if route == str(req.path):
+                    return handler(req)
+            elif req.path.match(route):
+                return handler(req)
+        return req.notfound()
+
+# The FastCGI servers that flup provides, and the keyword argument that
+# limits the number of requests each one handles at once
+SERVERS = {
+    "threaded": (flup.server.fcgi.WSGIServer, "maxThreads"),
+    "prefork": (flup.server.fcgi_fork.WSGIServer, "maxChildren"),
+}
+
 def main():
     app = APKVitrineApp()
-    flup.WSGIServer(app.handle).run()
+    conf = app.conf[apkvitrine.DEFAULT]
+    if conf["cgi.server"] not in SERVERS:
+        raise ValueError(f"unknown cgi.server {conf['cgi.server']!r}")
+    workers = conf.getint("cgi.workers")
+    if workers < 1:
+        raise ValueError("cgi.workers must be at least 1")
+    server, limit = SERVERS[conf["cgi.server"]]
+    # Both servers start maxSpare (by default 5) threads or children
+    # regardless of the limit, and prefork never runs fewer
+    server(
+        app.handle,
+        **{limit: workers},
+        maxSpare=min(5, workers),
+        minSpare=1,
+    ).run()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,174 @@
+# SPDX-License-Identifier: NCSA
+# Copyright (c) 2021 Max Rees
+# See LICENSE for more information.
+import base64       # b64encode
+import http.client  # HTTPConnection, HTTPException, HTTPSConnection
+import json         # loads
+import logging
+import threading    # local
+import time         # sleep
+import urllib.error # HTTPError
+import urllib.parse # unquote, urljoin, urlsplit
+import urllib.request # getproxies, proxy_bypass
+
+import apkvitrine.stats # count
+
+# Statuses worth retrying after a delay
+_RETRY_STATUS = {429, 500, 502, 503, 504}
+# Statuses that are followed to their Location, like urlopen() does
+_REDIRECT_STATUS = {301, 302, 307, 308}
+MAX_REDIRECTS = 10
+
+# Fetches JSON from one HTTP(S) host over keep-alive connections. Each
+# thread gets its own persistent connection to each host, so a thread
+# pool of N workers uses at most N connections per host. As with
+# urlopen(), redirects are followed and the proxies given by the
+# environment (http_proxy, https_proxy, no_proxy) are used.
+class JSONClient:
+    __slots__ = (
+        "_local",
+        "backoff",
+        "base",
+        "headers",
+        "proxies",
+        "retries",
+        "timeout",
+    )
+
+    def __init__(self, base, *, headers=None, retries=4, backoff=0.5,
+                 timeout=60):
+        self.base = base.rstrip("/") + "/"
+        self.headers = {"Accept": "application/json"}
+        self.headers.update(headers or {})
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.proxies = urllib.request.getproxies()
+        self._local = threading.local()
+
+    def _proxy(self, url):
+        proxy = self.proxies.get(url.scheme)
+        if not proxy or urllib.request.proxy_bypass(url.hostname):
+            return None, {}
+        if "://" not in proxy:
+            proxy = "http://" + proxy
+        proxy = urllib.parse.urlsplit(proxy)
+
+        headers = {}
+        if proxy.username:
+            auth = urllib.parse.unquote(proxy.username) + ":" \
+                + urllib.parse.unquote(proxy.password or "")
+            auth = base64.b64encode(auth.encode("utf-8")).decode("ascii")
+            headers["Proxy-Authorization"] = f"Basic {auth}"
+        return proxy, headers
+
+    def _connection(self, url):
+        # Returns the connection for the URL's host, and the request
+        # target and extra headers to send on it
+        conns = getattr(self._local, "conns", None)
+        if conns is None:
+            conns = self._local.conns = {}
+        key = (url.scheme, url.netloc)
+
+        if key not in conns:
+            if url.scheme == "https":
+                cls = http.client.HTTPSConnection
+            else:
+                cls = http.client.HTTPConnection
+            proxy, headers = self._proxy(url)
+            if not proxy:
+                conns[key] = (cls(url.netloc, timeout=self.timeout), None)
+            elif url.scheme == "https":
+                # Tunneled through the proxy with CONNECT
+                conn = cls(proxy.hostname, proxy.port, timeout=self.timeout)
+                conn.set_tunnel(url.hostname, url.port, headers)
+                conns[key] = (conn, None)
+            else:
+                # The proxy is sent the whole URL
+                conn = cls(proxy.hostname, proxy.port, timeout=self.timeout)
+                conns[key] = (conn, headers)
+
+        conn, headers = conns[key]
+        if headers is not None:
+            return conn, url.geturl(), headers
+        return conn, url.path + (f"?{url.query}" if url.query else ""), {}
+
+    def _close(self, url):
+        conns = getattr(self._local, "conns", {})
+        conn = conns.pop((url.scheme, url.netloc), None)
+        if conn is not None:
+            conn[0].close()
+
+    def request(self, path):
+        url = urllib.parse.urljoin(self.base, path)
+        for _ in range(MAX_REDIRECTS + 1):
+            response, body = self._fetch(urllib.parse.urlsplit(url))
+            location = response.headers.get("Location")
+            if response.status in _REDIRECT_STATUS and location:
+                url = urllib.parse.urljoin(url, location)
+                continue
+            if response.status >= 300:
+                raise urllib.error.HTTPError(
+                    url, response.status, response.reason,
+                    response.headers, None,
+                )
+            return json.loads(body), response.headers
+
+        raise urllib.error.HTTPError(
+            url, response.status, "Too many redirects", response.headers,
+            None,
+        )
+
+    def _fetch(self, url):
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2 ** attempt
+            try:
+                conn, target, headers = self._connection(url)
+                conn.request("GET", target, headers={**self.headers, **headers})
+                response = conn.getresponse()
+                body = response.read()
+                apkvitrine.stats.count("http.requests")
+                apkvitrine.stats.count("http.bytes", len(body))
+            except (OSError, http.client.HTTPException) as err:
+                self._close(url)
+                if attempt == self.retries:
+                    raise
+                logging.warning("%s: %s, retrying", url.geturl(), err)
+            else:
+                if response.will_close:
+                    self._close(url)
+                if response.status < 400:
+                    return response, body
+                if response.status not in _RETRY_STATUS \
+                        or attempt == self.retries:
+                    raise urllib.error.HTTPError(
+                        url.geturl(), response.status, response.reason,
+                        response.headers, None,
+                    )
+                logging.warning(
+                    "%s: HTTP %d, retrying", url.geturl(), response.status,
+                )
+                retry_after = response.headers.get("Retry-After", "")
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+
+            time.sleep(delay)
+
+        # Not reached
+        assert False
+
+    def get(self, path):
+        return self.request(path)[0]
+
+    def get_pages(self, path, per_page=100):
+        sep = "&" if "?" in path else "?"
+        path = f"{path}{sep}per_page={per_page}"
+
+        items = []
+        page = "1"
+        while page:
+            data, headers = self.request(f"{path}&page={page}")
+            items.extend(data)
+            # Gitlab leaves this empty on the last page
+            page = headers.get("X-Next-Page", "").strip()
+        return items
@@ -0,0 +1,16 @@
+-- Totals that the web application would otherwise have to count on
+-- every request. Refilled at the end of every build.
+
+CREATE TABLE IF NOT EXISTS counts (
+  name TEXT PRIMARY KEY,
+  total INTEGER NOT NULL
+);
+
+DELETE FROM counts;
+
+-- Top level packages, as listed on the branch page
+INSERT INTO counts (name, total)
+SELECT 'packages', COUNT(*) FROM packages WHERE origin IS NULL;
+
+INSERT INTO counts (name, total)
+SELECT 'subpackages', COUNT(*) FROM packages WHERE origin IS NOT NULL;
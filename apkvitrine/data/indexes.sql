@@ -0,0 +1,22 @@
+-- Created after the tables have been filled when building in bulk mode.
+-- Every statement must be safe to run again on an existing database.
+
+CREATE UNIQUE INDEX IF NOT EXISTS maintainers_name ON maintainers(name);
+CREATE UNIQUE INDEX IF NOT EXISTS packages_name ON packages(name);
+-- Subpackages of an origin, and top level packages by name or by date
+CREATE INDEX IF NOT EXISTS packages_origin_name ON packages(origin, name);
+CREATE INDEX IF NOT EXISTS packages_origin_updated ON packages(origin, updated);
+CREATE INDEX IF NOT EXISTS packages_maintainer ON packages(maintainer);
+
+CREATE INDEX IF NOT EXISTS versions_package ON versions(package, arch);
+
+CREATE INDEX IF NOT EXISTS deps_rdep ON deps(rdep, dep);
+CREATE INDEX IF NOT EXISTS deps_dep ON deps(dep, rdep);
+CREATE INDEX IF NOT EXISTS archdeps_rdep ON archdeps(rdep, dep);
+CREATE INDEX IF NOT EXISTS archdeps_dep ON archdeps(dep, rdep);
+CREATE INDEX IF NOT EXISTS missingdeps_package ON missingdeps(package);
+
+CREATE INDEX IF NOT EXISTS buglinks_package ON buglinks(package, bug);
+CREATE INDEX IF NOT EXISTS buglinks_bug ON buglinks(bug);
+CREATE INDEX IF NOT EXISTS mergelinks_package ON mergelinks(package, merge);
+CREATE INDEX IF NOT EXISTS mergelinks_merge ON mergelinks(merge);
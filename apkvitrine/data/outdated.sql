@@ -0,0 +1,30 @@
+-- Packages that are behind the newest version of their origin, or
+-- missing altogether, on some architecture. Refilled after the version
+-- table so that searches need not aggregate it on every request.
+-- No foreign keys: prune_packages() deletes packages that these rows
+-- still refer to until they are refilled.
+
+CREATE TABLE IF NOT EXISTS outdatedarches (
+  package INTEGER NOT NULL,
+  arch TEXT NOT NULL,
+  version TEXT
+);
+
+CREATE TABLE IF NOT EXISTS outdated (
+  package INTEGER PRIMARY KEY,
+  behind INTEGER NOT NULL,
+  missing INTEGER NOT NULL
+);
+
+DELETE FROM outdatedarches;
+DELETE FROM outdated;
+
+INSERT INTO outdatedarches (package, arch, version)
+SELECT package, arch, version FROM versions
+WHERE vrank > 0 OR version IS NULL;
+
+INSERT INTO outdated (package, behind, missing)
+SELECT package, COUNT(version), COUNT(*) - COUNT(version)
+FROM outdatedarches GROUP BY package;
+
+CREATE INDEX IF NOT EXISTS outdatedarches_package ON outdatedarches(package);
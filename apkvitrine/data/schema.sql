@@ -1,5 +1,11 @@
 PRAGMA foreign_keys = ON;
 
+CREATE TABLE maintainers (
+  id INTEGER PRIMARY KEY,
+  name TEXT NOT NULL,
+  packages INTEGER NOT NULL
+);
+
 CREATE TABLE packages (
   id INTEGER PRIMARY KEY,
   startdir TEXT NOT NULL,
@@ -9,7 +15,7 @@ CREATE TABLE packages (
   url TEXT,
   license TEXT,
   origin INTEGER REFERENCES packages(id),
-  maintainer TEXT,
+  maintainer INTEGER REFERENCES maintainers(id),
   revision TEXT,
   size INTEGER,
   updated INTEGER
@@ -17,7 +23,7 @@ CREATE TABLE packages (
 
 CREATE TABLE versions (
   id INTEGER PRIMARY KEY,
-  package NOT NULL REFERENCES packages(id),
+  package INTEGER NOT NULL REFERENCES packages(id),
   arch TEXT NOT NULL,
   version TEXT,
   vrank INTEGER,
@@ -41,18 +47,18 @@ BEGIN
 END;
 
 CREATE TABLE deps (
-  rdep NOT NULL REFERENCES packages(id),
-  dep NOT NULL REFERENCES packages(id)
+  rdep INTEGER NOT NULL REFERENCES packages(id),
+  dep INTEGER NOT NULL REFERENCES packages(id)
 );
 
 CREATE TABLE archdeps (
   arch TEXT NOT NULL,
-  rdep NOT NULL REFERENCES packages(id),
-  dep NOT NULL REFERENCES packages(id)
+  rdep INTEGER NOT NULL REFERENCES packages(id),
+  dep INTEGER NOT NULL REFERENCES packages(id)
 );
 
 CREATE TABLE missingdeps (
-  package NOT NULL REFERENCES packages(id),
+  package INTEGER NOT NULL REFERENCES packages(id),
   arch TEXT NOT NULL,
   dep TEXT NOT NULL
 );
@@ -65,8 +71,8 @@ CREATE TABLE bugs (
 );
 
 CREATE TABLE buglinks (
-  bug NOT NULL REFERENCES bugs(id),
-  package NOT NULL REFERENCES packages(id)
+  bug INTEGER NOT NULL REFERENCES bugs(id),
+  package INTEGER NOT NULL REFERENCES packages(id)
 );
 
 CREATE TRIGGER pkg_bugged
@@ -87,8 +93,8 @@ CREATE TABLE merges (
 );
 
 CREATE TABLE mergelinks (
-  merge NOT NULL REFERENCES merges(id),
-  package NOT NULL REFERENCES packages(id)
+  merge INTEGER NOT NULL REFERENCES merges(id),
+  package INTEGER NOT NULL REFERENCES packages(id)
 );
 
 CREATE TRIGGER pkg_merged
@@ -0,0 +1,21 @@
+-- Full text index over the columns that can be searched. The trigram
+-- tokenizer (sqlite 3.34+) matches any substring of three or more
+-- characters regardless of case, so package names like "py3-foo.bar"
+-- or "so:libfoo.so.1" need no special treatment.
+
+CREATE VIRTUAL TABLE IF NOT EXISTS packages_fts USING fts5(
+  repo,
+  name,
+  description,
+  url,
+  license,
+  content='packages',
+  content_rowid='id',
+  tokenize='trigram'
+);
+
+-- Rank name matches highest and repository or license matches lowest
+INSERT INTO packages_fts(packages_fts, rank)
+VALUES ('rank', 'bm25(0.5, 10.0, 2.0, 1.0, 0.5)');
+
+INSERT INTO packages_fts(packages_fts) VALUES ('rebuild');
@@ -0,0 +1,81 @@
+# SPDX-License-Identifier: NCSA
+# Copyright (c) 2021 Max Rees
+# See LICENSE for more information.
+import collections # defaultdict, namedtuple
+import functools   # lru_cache
+import re          # compile
+
+import apkvitrine.version # APK_OPS, ver_is, verkey
+
+Spec = collections.namedtuple(
+    "Spec", (
+        "name",
+        "op",
+        "version",
+        "conflict",
+    ),
+)
+
+_SPEC_RE = re.compile(r"(!?)([^<>=~]+)(?:([<>=~]+)(.*))?")
+
+@functools.lru_cache(maxsize=None)
+def parse_spec(spec):
+    match = _SPEC_RE.fullmatch(spec)
+    if not match:
+        return Spec(spec, None, None, False)
+
+    conflict, name, op, version = match.groups()
+    if op not in apkvitrine.version.APK_OPS:
+        op = version = None
+    return Spec(name, op, version, bool(conflict))
+
+class Providers:
+    __slots__ = (
+        "_index",
+        "_resolved",
+    )
+
+    def __init__(self, pkgs):
+        # name -> [(pkg, provided version or None), ...]
+        self._index = collections.defaultdict(list)
+        self._resolved = {}
+
+        for pkg in pkgs:
+            self._index[pkg.name].append((pkg, pkg.version))
+            for prov in pkg.provides:
+                prov = parse_spec(prov)
+                self._index[prov.name].append((pkg, prov.version))
+
+    def candidates(self, spec):
+        spec = parse_spec(spec)
+        candidates = self._index.get(spec.name, ())
+        if not spec.op:
+            return list(candidates)
+
+        return [
+            (pkg, ver) for pkg, ver in candidates
+            if ver and apkvitrine.version.ver_is(ver, spec.op, spec.version)
+        ]
+
+    def resolve(self, spec):
+        try:
+            return self._resolved[spec]
+        except KeyError:
+            pass
+
+        name = parse_spec(spec).name
+        candidates = self.candidates(spec)
+        if candidates:
+            # Prefer a real package by that name, then the highest
+            # provider_priority, then the highest provided version
+            pkg, _ = max(candidates, key=lambda i: (
+                i[0].name == name,
+                i[0].provider_priority or 0,
+                apkvitrine.version.verkey(i[1]) if i[1] else (),
+                i[0].name,
+            ))
+        else:
+            pkg = None
+
+        self._resolved[spec] = pkg
+        return pkg
@@ -3,6 +3,9 @@
 # See LICENSE for more information.
 import collections # namedtuple
 import datetime    # datetime, timezone
+import json        # dumps, loads
+import re          # compile
+import sqlite3     # OperationalError
 
 def _insert(table, columns):
     values = ", ".join("?" for i in columns)
@@ -23,6 +26,22 @@ class DbModel:
     def factory(cls, _, row):
         return cls(*row)
 
+def maintainer_name(maintainer):
+    # "Name <email>" to "Name"
+    return maintainer.split(" <")[0]
+
+_Maintainer = collections.namedtuple(
+    "Maintainer", (
+        "id",
+        "name",
+        "packages",
+    ),
+)
+class Maintainer(_Maintainer, DbModel):
+    __slots__ = ()
+    _table = "maintainers"
+    _insert_sql = _insert(_table, _Maintainer._fields)
+
 _Pkg = collections.namedtuple(
     "Pkg", (
         "id",
@@ -45,13 +64,28 @@ class Pkg(_Pkg, DbModel):
     _insert_sql = _insert(_table, _Pkg._fields)
 
     @classmethod
-    def from_index(cls, pkg, startdir, origin):
+    def from_index(cls, pkg, startdir, origin, maintainers):
+        maintainer = None
+        if pkg.maintainer:
+            maintainer = maintainers[maintainer_name(pkg.maintainer)]
         return cls(
             None, startdir, pkg.repo, pkg.name,
             pkg.description, pkg.url, pkg.license,
-            origin, pkg.maintainer, pkg.commit, None, None,
+            origin, maintainer, pkg.commit, None, None,
         )
 
+    @classmethod
+    def get_by_name(cls, db, name):
+        old_factory = db.row_factory
+        db.row_factory = Pkg.factory
+
+        pkg = db.execute("""
+            SELECT * FROM packages WHERE name = ?;
+        """, (name,)).fetchone()
+
+        db.row_factory = old_factory
+        return pkg
+
     def get_origin(self, db):
         if not self.origin:
             return None
@@ -66,91 +100,33 @@ class Pkg(_Pkg, DbModel):
         db.row_factory = old_factory
         return origin
 
-    def get_subpkgs(self, db):
-        if self.origin:
+    def get_maintainer(self, db):
+        if not self.maintainer:
             return None
 
         old_factory = db.row_factory
-        db.row_factory = Pkg.factory
-
-        subpkgs = db.execute("""
-            SELECT * FROM packages WHERE origin = ?;
-        """, (self.id,)).fetchall()
-
-        db.row_factory = old_factory
-        return subpkgs
-
-    def get_versions(self, db):
-        old_factory = db.row_factory
-        db.row_factory = Version.factory
-
-        versions = db.execute("""
-            SELECT
-                id, package, arch, IFNULL(version, ""), vrank,
-                size, revision, created
-            FROM versions WHERE package = ?;
-        """, (self.id,)).fetchall()
-
-        db.row_factory = old_factory
-        return versions
+        db.row_factory = Maintainer.factory
 
-    def get_deps(self, db, reverse=False):
-        old_factory = db.row_factory
-        db.row_factory = Archdep.factory
-        if reverse:
-            join = "rdep"
-            where = "dep"
-        else:
-            join = "dep"
-            where = "rdep"
-
-        deps = list(db.execute(f"""
-            SELECT NULL, 1, packages.name FROM deps
-            INNER JOIN packages ON packages.id = deps.{join}
-            WHERE {where} = ?;
-        """, (self.id,)).fetchall())
-
-        deps += list(db.execute(f"""
-            SELECT archdeps.arch, 1, packages.name FROM archdeps
-            INNER JOIN packages ON packages.id = archdeps.{join}
-            WHERE {where} = ?;
-        """, (self.id,)).fetchall())
-
-        if not reverse:
-            deps += list(db.execute("""
-                SELECT missingdeps.arch, NULL, missingdeps.dep FROM missingdeps
-                INNER JOIN packages ON packages.id = missingdeps.package
-                WHERE packages.id = ?;
-            """, (self.id,)).fetchall())
+        maintainer = db.execute("""
+            SELECT * FROM maintainers WHERE id = ?;
+        """, (self.maintainer,)).fetchone()
 
         db.row_factory = old_factory
-        return deps
-
-    def get_bugs(self, db):
-        old_factory = db.row_factory
-        db.row_factory = Bug.factory
-
-        bugs = db.execute("""
-            SELECT bugs.*
-            FROM buglinks INNER JOIN bugs ON bugs.id = buglinks.bug
-            WHERE buglinks.package = ?;
-        """, (self.id,)).fetchall()
+        return maintainer
 
-        db.row_factory = old_factory
-        return bugs
+    def get_subpkgs(self, db):
+        if self.origin:
+            return None
 
-    def get_merges(self, db):
         old_factory = db.row_factory
-        db.row_factory = Merge.factory
+        db.row_factory = Pkg.factory
 
-        merges = db.execute("""
-            SELECT merges.*
-            FROM mergelinks INNER JOIN merges ON merges.id = mergelinks.merge
-            WHERE mergelinks.package = ?;
+        subpkgs = db.execute("""
+            SELECT * FROM packages WHERE origin = ?;
         """, (self.id,)).fetchall()
 
         db.row_factory = old_factory
-        return merges
+        return subpkgs
 
 _Version = collections.namedtuple(
     "Version", (
@@ -252,6 +228,75 @@ class Mergelink(_Mergelink, DbModel):
     _table = "mergelinks"
     _insert_sql = _insert(_table, _Mergelink._fields)
 
+# Rows related to a package, as loaded by load_related()
+Related = collections.namedtuple(
+    "Related", (
+        "versions",
+        "deps",
+        "rdeps",
+        "bugs",
+        "merges",
+    ),
+)
+
+# The model and query for each field of Related. The first column of
+# each row is the package that the rest of the row belongs to.
+_RELATED_SQL = {
+    "versions": (Version, """
+        SELECT
+            package, id, package, arch, IFNULL(version, ""), vrank,
+            size, revision, created
+        FROM versions WHERE package IN ({ids});
+    """),
+    "deps": (Archdep, """
+        SELECT deps.rdep, NULL, 1, packages.name FROM deps
+        INNER JOIN packages ON packages.id = deps.dep
+        WHERE deps.rdep IN ({ids})
+        UNION ALL
+        SELECT archdeps.rdep, archdeps.arch, 1, packages.name FROM archdeps
+        INNER JOIN packages ON packages.id = archdeps.dep
+        WHERE archdeps.rdep IN ({ids})
+        UNION ALL
+        SELECT package, arch, NULL, dep FROM missingdeps
+        WHERE package IN ({ids});
+    """),
+    "rdeps": (Archdep, """
+        SELECT deps.dep, NULL, 1, packages.name FROM deps
+        INNER JOIN packages ON packages.id = deps.rdep
+        WHERE deps.dep IN ({ids})
+        UNION ALL
+        SELECT archdeps.dep, archdeps.arch, 1, packages.name FROM archdeps
+        INNER JOIN packages ON packages.id = archdeps.rdep
+        WHERE archdeps.dep IN ({ids});
+    """),
+    "bugs": (Bug, """
+        SELECT buglinks.package, bugs.*
+        FROM buglinks INNER JOIN bugs ON bugs.id = buglinks.bug
+        WHERE buglinks.package IN ({ids});
+    """),
+    "merges": (Merge, """
+        SELECT mergelinks.package, merges.*
+        FROM mergelinks INNER JOIN merges ON merges.id = mergelinks.merge
+        WHERE mergelinks.package IN ({ids});
+    """),
+}
+
+def load_related(db, ids, fields=Related._fields):
+    # One query per field, however many packages are given
+    ids = list(ids)
+    related = {i: Related([], [], [], [], []) for i in ids}
+    if not ids:
+        return related
+
+    params = ", ".join(f"?{i}" for i in range(1, len(ids) + 1))
+    cur = db.cursor()
+    cur.row_factory = None
+    for field in fields:
+        model, sql = _RELATED_SQL[field]
+        for row in cur.execute(sql.format(ids=params), ids):
+            getattr(related[row[0]], field).append(model(*row[1:]))
+    return related
+
 _FUZZY_COLUMNS = (
     "repo",
     "name",
@@ -268,17 +313,69 @@ _CROSS_COLUMNS = {
     "merges": ("mergelinks", None, "package"),
 }
 
+# Sort orders for searches: the ORDER BY terms, and the columns and
+# comparison with which the next page continues after the last row of
+# the previous one. Results ranked by relevance have no such key.
 _SORT = {
-    "name": "name",
-    "updated": "updated",
+    "name": ("packages.name", ("name",), ">"),
+    "updated": ("packages.updated, packages.id", ("updated", "id"), ">"),
+    "relevance": (
+        "packages.name = :exact COLLATE NOCASE DESC, fts.rank, packages.name",
+        None, None,
+    ),
 }
 
-def build_search(query):
+# Searches count at most this many pages of results past the current one
+COUNT_PAGES = 20
+
+# Glob operators, which split a search term into literal fragments
+_GLOB_RE = re.compile(r"\[[^]]*\]?|[*?]")
+
+def _fts_phrases(col, term):
+    # The trigram tokenizer can only match fragments of three or more
+    # characters; shorter ones are left to the GLOB
+    return [
+        f'{col} : "{i}"' for i in
+        (i.replace('"', '""') for i in _GLOB_RE.split(term))
+        if len(i) >= 3
+    ]
+
+def has_search_index(db):
+    return bool(db.execute("""
+        SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'packages_fts';
+    """).fetchone())
+
+def _keyset(query, order, keyset, op):
+    query["order"] = order
+    query["keyset"] = keyset
+    if not keyset:
+        return None
+
+    try:
+        after = json.loads(query.get("after") or "null")
+    except ValueError:
+        after = None
+    # A NULL in the key cannot be compared, and anything but a string or
+    # number cannot be bound; such pages fall back to OFFSET
+    if not isinstance(after, list) or len(after) != len(keyset) \
+            or not all(
+                isinstance(i, (str, int, float)) and not isinstance(i, bool)
+                for i in after
+            ):
+        return None
+
+    query["cursor"] = True
+    for col, value in zip(keyset, after):
+        query[f"after_{col}"] = value
+    cols = ", ".join(f"packages.{i}" for i in keyset)
+    values = ", ".join(f":after_{i}" for i in keyset)
+    return f"({cols}) {op} ({values})"
+
+def build_search(query, fts=False):
     sql = "SELECT DISTINCT packages.* FROM packages"
 
-    vers = query.get("vers")
-    if vers:
-        sql += " INNER JOIN versions ON versions.package = packages.id"
+    if query.get("vers"):
+        sql += " INNER JOIN outdated ON outdated.package = packages.id"
 
     for field, (table, alias, col) in _CROSS_COLUMNS.items():
         if not query.get(field):
@@ -288,11 +385,17 @@ def build_search(query):
         sql += f" INNER JOIN {table} {alias} ON {alias}.{col} = packages.id"
 
     constraints = []
+    phrases = []
+    exact = _GLOB_RE.sub("", query.get("name") or "")
 
     cs = query.get("cs")
     for col in _FUZZY_COLUMNS:
         if not query.get(col):
             continue
+        if fts:
+            # The full text index narrows down the candidates, and the
+            # GLOB keeps the exact semantics
+            phrases += _fts_phrases(col, query[col])
         if cs:
             constraints.append(f"packages.{col} GLOB :{col}")
         else:
@@ -303,8 +406,10 @@ def build_search(query):
     if maint == "None":
         constraints.append("packages.maintainer IS NULL")
     elif maint:
-        query["maintainer"] += " <*"
-        constraints.append("packages.maintainer GLOB :maintainer")
+        constraints.append(
+            "packages.maintainer = "
+            "(SELECT id FROM maintainers WHERE name = :maintainer)"
+        )
 
     if not query.get("subpkgs"):
         constraints.append("packages.origin IS NULL")
@@ -312,17 +417,113 @@ def build_search(query):
     if query.get("dirty"):
         constraints.append("packages.revision GLOB '*-dirty'")
 
+    if phrases:
+        query["fts"] = " AND ".join(phrases)
+        query["exact"] = exact
+        sql += (
+            " INNER JOIN ("
+            "SELECT rowid, rank FROM packages_fts WHERE packages_fts MATCH :fts"
+            ") fts ON fts.rowid = packages.id"
+        )
+
+    sort = query.get("sort") or ("relevance" if phrases else "name")
+    if sort not in _SORT or (sort == "relevance" and not phrases):
+        sort = "name"
+    after = _keyset(query, *_SORT[sort])
+    if after:
+        constraints.append(after)
+
     if constraints:
         sql = f"{sql} WHERE {' AND '.join(constraints)}"
 
-    if vers:
-        sql += " GROUP BY packages.name, versions.arch HAVING (MIN(versions.vrank) > 0 OR versions.version IS NULL)"
-
-    sort = _SORT.get(query.get("sort"), "name")
-    sql += f" ORDER BY {sort}"
+    # The ORDER BY is added by paginate()
+    return sql
 
+def build_branch(query):
+    sql = "SELECT * FROM packages WHERE origin IS NULL"
+    after = _keyset(query, "updated DESC, id DESC", ("updated", "id"), "<")
+    if after:
+        sql += f" AND {after}"
     return sql
 
+def get_count(db, name):
+    old_factory = db.row_factory
+    db.row_factory = None
+    try:
+        total = db.execute("""
+            SELECT total FROM counts WHERE name = ?;
+        """, (name,)).fetchone()
+    except sqlite3.OperationalError:
+        # Built before counts were kept
+        total = None
+    db.row_factory = old_factory
+    return total[0] if total else None
+
+def get_names(db):
+    old_factory = db.row_factory
+    db.row_factory = None
+    names = [i[0] for i in db.execute("""
+        SELECT name FROM packages ORDER BY name;
+    """)]
+    db.row_factory = old_factory
+    return names
+
+def paginate(db, sql, query, limit, total=None):
+    query["limit"] = limit
+    try:
+        query["page"] = max(1, int(query.get("page", "1")))
+    except ValueError:
+        query["page"] = 1
+    skipped = (query["page"] - 1) * limit
+    # With a cursor from the previous page, the query itself skips the
+    # rows before it
+    query["offset"] = 0 if query.get("cursor") else skipped
+
+    query["estimate"] = False
+    if total is None:
+        # Counting every result would mean evaluating the whole query,
+        # so stop some pages past the current one
+        query["cap"] = query["offset"] + limit * COUNT_PAGES
+        total = db.execute(
+            f"SELECT COUNT(*) FROM ({sql} LIMIT :cap)", query,
+        ).fetchone()[0]
+        query["estimate"] = total == query["cap"]
+        total += skipped - query["offset"]
+    query["total"] = total
+
+    old_factory = db.row_factory
+    db.row_factory = Pkg.factory
+    sql += f" ORDER BY {query['order']} LIMIT :limit + 1 OFFSET :offset"
+    pkgs = db.execute(sql, query).fetchall()
+    db.row_factory = old_factory
+
+    query["next"] = None
+    query["more"] = len(pkgs) > limit
+    if query["more"]:
+        pkgs = pkgs[:limit]
+        if query["keyset"]:
+            query["next"] = json.dumps(
+                [getattr(pkgs[-1], i) for i in query["keyset"]],
+            )
+    return pkgs
+
+def get_maintainers(db):
+    old_factory = db.row_factory
+    db.row_factory = Maintainer.factory
+    maints = db.execute("""
+        SELECT * FROM maintainers ORDER BY name;
+    """).fetchall()
+
+    db.row_factory = None
+    orphans = db.execute("""
+        SELECT COUNT(*) FROM packages WHERE maintainer IS NULL;
+    """).fetchone()[0]
+    db.row_factory = old_factory
+
+    if orphans:
+        maints.insert(0, Maintainer(None, "None", orphans))
+    return maints
+
 def gl_strptime(s):
     # 2020-12-22T23:53:51.993Z
     s, micro = s.split(".", maxsplit=1)
@@ -0,0 +1,294 @@
+# SPDX-License-Identifier: NCSA
+# Copyright (c) 2021 Max Rees
+# See LICENSE for more information.
+import collections # OrderedDict
+import gzip        # GzipFile
+import io          # BytesIO
+import os          # getpid, replace, scandir, stat, utime, walk
+import shutil      # rmtree
+import threading   # get_ident, Lock
+import time        # time
+from pathlib import Path
+
+# Eviction frees this much more than needed so that it does not run again
+# on the next write
+_EVICT_TO = 0.9
+
+# Content codings that each page is also stored in, with the suffix of
+# its file. None is the page itself.
+ENCODINGS = {
+    None: ".html",
+    "gzip": ".html.gz",
+}
+
+def generation(path):
+    # Changes whenever the file is renamed over or written to
+    stat = os.stat(path)
+    return f"{stat.st_ino:x}-{stat.st_mtime_ns:x}"
+
+def _mtime_ns(gen):
+    # Generations of the same file are ordered by this
+    return int(gen.split("-")[1], 16)
+
+def generation_time(gen):
+    # The modification time of the file, in seconds
+    return _mtime_ns(gen) / 1e9
+
+def compress(page):
+    # Without a timestamp, so that the same page always compresses to
+    # the same bytes in every process
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as f:
+        f.write(page)
+    return buf.getvalue()
+
+def variants(page):
+    return {None: page, "gzip": compress(page)}
+
+class PageCache:
+    # Pages are stored as {root}/{group}@{generation}/{path}.html, and
+    # compressed next to it with the suffixes in ENCODINGS. Storing a
+    # page under a new generation of a group deletes the older ones, and
+    # pages of an older generation than one already stored are dropped.
+    # The access time of each file is set when it is read, and the least
+    # recently read pages are evicted once there are more than max_bytes
+    # or max_entries of them (0 for no limit).
+    __slots__ = (
+        "_bytes",
+        "_entries",
+        "_lock",
+        "_written",
+        "evictions",
+        "max_bytes",
+        "max_entries",
+        "root",
+    )
+
+    def __init__(self, root, max_bytes=0, max_entries=0):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # Totals as of the last scan plus what this process has written
+        # since; other processes may share the directory
+        self._bytes = self._entries = None
+        # What this process has written since the last scan. Once it is
+        # more than the room left by an eviction, the other processes
+        # may have written as much, so the directory is scanned again.
+        self._written = (0, 0)
+        # Files deleted by this process to make room
+        self.evictions = 0
+
+    def name(self, group, gen, path, encoding=None):
+        return self.root / f"{group}@{gen}" / path.parent \
+            / (path.name + ENCODINGS[encoding])
+
+    def get(self, group, gen, path, encoding=None):
+        cache = self.name(group, gen, path, encoding)
+        try:
+            page = cache.read_bytes()
+            stat = cache.stat()
+            # time.time_ns() needs Python 3.7
+            os.utime(cache, ns=(int(time.time() * 1e9), stat.st_mtime_ns))
+        except FileNotFoundError:
+            # Possibly evicted in the meantime
+            return None
+        return page
+
+    def age(self, group, gen, path):
+        try:
+            stat = self.name(group, gen, path).stat()
+        except FileNotFoundError:
+            return None
+        return time.time() - stat.st_mtime
+
+    def remove(self, group, gen, path):
+        for encoding in ENCODINGS:
+            try:
+                self.name(group, gen, path, encoding).unlink()
+            except FileNotFoundError:
+                pass
+
+    def put(self, group, gen, path, page, encoding=None):
+        cache = self.name(group, gen, path, encoding)
+        top = self.root / f"{group}@{gen}"
+        if not top.is_dir() and not self._prune(group, gen):
+            # Rendered from a database that has since been replaced
+            return
+
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        # Readers only ever see complete pages
+        tmp = cache.with_name(
+            f".{cache.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        tmp.write_bytes(page)
+        os.replace(tmp, cache)
+
+        with self._lock:
+            self._written = (self._written[0] + len(page), self._written[1] + 1)
+            if self._bytes is None \
+                    or self._over(*self._written, 1 - _EVICT_TO):
+                self._scan()
+            else:
+                self._bytes += len(page)
+                self._entries += 1
+            if self._over(self._bytes, self._entries):
+                self._evict()
+
+    def _prune(self, group, gen):
+        # Returns False instead if there is a newer generation
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return True
+
+        older = []
+        for entry in entries:
+            other_group, _, other = entry.name.rpartition("@")
+            if other_group != group or other == gen:
+                continue
+            try:
+                if _mtime_ns(other) > _mtime_ns(gen):
+                    return False
+                if _mtime_ns(other) < _mtime_ns(gen):
+                    older.append(entry.path)
+            except (IndexError, ValueError):
+                continue
+
+        for path in older:
+            shutil.rmtree(path, ignore_errors=True)
+        with self._lock:
+            self._bytes = self._entries = None
+        return True
+
+    def _over(self, size, entries, factor=1):
+        return (
+            (self.max_bytes and size > self.max_bytes * factor)
+            or (self.max_entries and entries > self.max_entries * factor)
+        )
+
+    def _files(self):
+        files = []
+        for parent, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(parent, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_atime_ns, stat.st_size, path))
+        return files
+
+    def _scan(self):
+        files = self._files()
+        self._bytes = sum(i[1] for i in files)
+        self._entries = len(files)
+        self._written = (0, 0)
+
+    def _evict(self):
+        files = sorted(self._files())
+        size = sum(i[1] for i in files)
+        entries = len(files)
+        for _, file_size, path in files:
+            if not self._over(size, entries, _EVICT_TO):
+                break
+            try:
+                os.unlink(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            size -= file_size
+            entries -= 1
+        self._bytes = size
+        self._entries = entries
+        self._written = (0, 0)
+
+class MemoryCache:
+    # Rendered pages kept by a single process, keyed on a tuple whose
+    # first two items are the group and generation as for PageCache and
+    # whose last item is the content coding of the page.
+    # Pages of older generations of a group are dropped as soon as one
+    # of a newer generation is stored, and pages of an older generation
+    # than one already stored are not kept.
+    __slots__ = (
+        "_entries",
+        "_generations",
+        "_lock",
+        "bytes",
+        "evictions",
+        "hits",
+        "max_bytes",
+        "misses",
+    )
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._generations = {}
+        self._lock = threading.Lock()
+        self.bytes = self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def age(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        return None if entry is None else time.time() - entry[0]
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= len(entry[1])
+
+    def put(self, key, page):
+        if len(page) > self.max_bytes:
+            return
+
+        group, gen = key[:2]
+        with self._lock:
+            newest = self._generations.get(group, gen)
+            if _mtime_ns(gen) < _mtime_ns(newest):
+                # Rendered from a database that has since been replaced
+                return
+            if _mtime_ns(gen) > _mtime_ns(newest):
+                for old in [
+                        i for i in self._entries
+                        if i[0] == group and _mtime_ns(i[1]) < _mtime_ns(gen)
+                ]:
+                    self.bytes -= len(self._entries.pop(old)[1])
+                self._generations[group] = gen
+            else:
+                self._generations.setdefault(group, gen)
+
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[1])
+            self._entries[key] = (time.time(), page)
+            self.bytes += len(page)
+
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
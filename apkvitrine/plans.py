@@ -0,0 +1,190 @@
+# SPDX-License-Identifier: NCSA
+# Copyright (c) 2021 Max Rees
+# See LICENSE for more information.
+import argparse # ArgumentParser
+import logging
+import re       # compile
+import sqlite3  # Connection, connect
+import sys      # exit
+import tempfile # mkdtemp
+from pathlib import Path
+
+import apkvitrine.bench  # bench
+import apkvitrine.models # build_branch, build_search, get_count,
+                         # get_maintainers, has_search_index,
+                         # load_related, paginate, Pkg, Related
+
+# A table read from start to end, as opposed to SCAN (subquery-N) or
+# SCAN CONSTANT ROW. SQLite before 3.36 says SCAN TABLE instead.
+_SCAN_RE = re.compile(r"SCAN (?:TABLE )?([a-z_]+)(?: AS \w+)?(?: USING .*)?$")
+
+# Representative search forms, each with the tables that it may scan.
+# Only searches that include subpackages have to look at every package,
+# and with the full text index only if no term is long enough for it.
+# None means that packages may only be scanned without the index.
+_SEARCHES = (
+    ({"name": "lib"}, ()),
+    ({"name": "LIB", "cs": "on"}, ()),
+    ({"description": "bench", "url": "example"}, ()),
+    ({"license": "MIT", "repo": "system"}, ()),
+    ({"name": "dev", "subpkgs": "on"}, None),
+    ({"name": "py", "subpkgs": "on"}, ("packages",)),
+    ({"name": "*-dev", "description": "doc", "subpkgs": "on"}, None),
+    ({"maintainer": "Maintainer 1"}, ()),
+    ({"maintainer": "None"}, ()),
+    ({"dirty": "on"}, ()),
+    ({"sort": "updated", "name": "x"}, ()),
+    ({"sort": "name", "name": "lib", "after": '["lib"]'}, ()),
+    ({"sort": "updated", "after": "[1600000000, 1]"}, ()),
+    ({"deps": "on"}, ()),
+    ({"rdeps": "on"}, ()),
+    ({"mdeps": "on"}, ()),
+    ({"bugs": "on"}, ()),
+    ({"merges": "on"}, ()),
+    ({"vers": "on"}, ()),
+    ({"vers": "on", "deps": "on", "subpkgs": "on"}, ("packages",)),
+)
+
+class _RecordingCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        self.connection.statements.append((sql, parameters))
+        return super().execute(sql, parameters)
+
+class _Recorder(sqlite3.Connection):
+    # Remembers every statement run through execute(), whether on the
+    # connection or on one of its cursors
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = []
+
+    def cursor(self, factory=_RecordingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+def explain(db, sql, parameters):
+    cur = db.cursor()
+    cur.row_factory = None
+    return [
+        row[3] for row in
+        cur.execute("EXPLAIN QUERY PLAN " + sql, parameters).fetchall()
+    ]
+
+def record(db, name, func, allowed=()):
+    db.statements = []
+    func()
+    return [(name, sql, parameters, allowed) for sql, parameters in db.statements]
+
+def production_queries(db, limit=50):
+    pkg = db.execute("""
+        SELECT name FROM packages WHERE origin IS NOT NULL LIMIT 1;
+    """).fetchone()[0]
+    pkg = apkvitrine.models.Pkg.get_by_name(db, pkg)
+    origin = pkg.get_origin(db)
+
+    queries = []
+    queries += record(
+        db, "package", lambda: apkvitrine.models.Pkg.get_by_name(db, pkg.name),
+    )
+    queries += record(db, "origin", lambda: pkg.get_origin(db))
+    maintained = db.execute("""
+        SELECT name FROM packages WHERE maintainer IS NOT NULL LIMIT 1;
+    """).fetchone()
+    if maintained:
+        maintained = apkvitrine.models.Pkg.get_by_name(db, maintained[0])
+        queries += record(
+            db, "maintainer", lambda: maintained.get_maintainer(db),
+        )
+    queries += record(db, "subpkgs", lambda: origin.get_subpkgs(db))
+    ids = [pkg.id, origin.id]
+    for field in apkvitrine.models.Related._fields:
+        queries += record(
+            db, field,
+            lambda field=field: apkvitrine.models.load_related(db, ids, (field,)),
+        )
+    # Every maintainer has to be listed
+    queries += record(
+        db, "maintainers", lambda: apkvitrine.models.get_maintainers(db),
+        ("maintainers",),
+    )
+    queries += record(
+        db, "count", lambda: apkvitrine.models.get_count(db, "packages"),
+    )
+    branch = {"page": "2"}
+    queries += record(db, "branch", lambda: apkvitrine.models.paginate(
+        db, apkvitrine.models.build_branch(branch), branch, limit,
+    ))
+    # The following page, continuing after the last row of this one
+    branch = {"page": "3", "after": branch["next"]}
+    queries += record(db, "branch after", lambda: apkvitrine.models.paginate(
+        db, apkvitrine.models.build_branch(branch), branch, limit,
+    ))
+
+    fts = apkvitrine.models.has_search_index(db)
+    for query, allowed in _SEARCHES:
+        name = "search " + " ".join(f"{i}={j}" for i, j in query.items())
+        if allowed is None:
+            allowed = () if fts else ("packages",)
+        query = dict(query)
+        queries += record(db, name, lambda query=query: apkvitrine.models.paginate(
+            db, apkvitrine.models.build_search(query, fts), query, limit,
+        ), allowed)
+
+    return queries
+
+def check(path, verbose=False):
+    db = sqlite3.connect(str(path), factory=_Recorder)
+    ok = True
+    for name, sql, parameters, allowed in production_queries(db):
+        try:
+            plan = explain(db, sql, parameters)
+        except sqlite3.OperationalError as err:
+            # e.g. a table that the database was built without
+            ok = False
+            print(f"{name}: {err}")
+            print("  " + " ".join(sql.split()))
+            continue
+        scans = [
+            match.group(1) for match in map(_SCAN_RE.match, plan) if match
+        ]
+        bad = [i for i in scans if i not in allowed]
+        if bad:
+            ok = False
+        if bad or verbose:
+            status = f"FULL SCAN of {', '.join(bad)}" if bad else "ok"
+            print(f"{name}: {status}")
+            print("  " + " ".join(sql.split()))
+            for line in plan:
+                print(f"    {line}")
+    db.close()
+    return ok
+
+if __name__ == "__main__":
+    opts = argparse.ArgumentParser(
+        usage="python3 -m apkvitrine.plans [options ...] [DATABASE]",
+        description="check that the web application's queries use indexes",
+    )
+    opts.add_argument(
+        "-n", "--size", type=int, default=2000,
+        help="number of packages to generate if no database is given",
+    )
+    opts.add_argument(
+        "-v", "--verbose", action="store_true",
+        help="show the query plan of every query",
+    )
+    opts.add_argument(
+        "db", metavar="DATABASE", nargs="?",
+        help="database to check instead of a synthetic one",
+    )
+    opts = opts.parse_args()
+    logging.basicConfig(level="ERROR")
+
+    if opts.db:
+        db = Path(opts.db)
+    else:
+        workdir = Path(tempfile.mkdtemp(prefix="apkvitrine-plans."))
+        apkvitrine.bench.bench(workdir, [opts.size])
+        db = workdir / "out" / f"n{opts.size}.sqlite"
+
+    sys.exit(0 if check(db, opts.verbose) else 1)
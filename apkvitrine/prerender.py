@@ -0,0 +1,153 @@
+# SPDX-License-Identifier: NCSA
+# Copyright (c) 2021 Max Rees
+# See LICENSE for more information.
+import argparse           # ArgumentParser
+import concurrent.futures # ProcessPoolExecutor
+import functools          # partial
+import logging
+import os                 # cpu_count
+import sqlite3            # connect, OperationalError
+import sys                # exit
+import time               # perf_counter
+from pathlib import Path
+
+import apkvitrine        # BUILDERS, config, DEFAULT
+import apkvitrine.cgi    # APKVitrineApp
+import apkvitrine.models # get_names
+import apkvitrine.pagecache # ENCODINGS
+
+# Number of pages that a worker renders per task
+CHUNK_SIZE = 100
+
+# Each worker process sets up its own application, and with it its own
+# database connections, on its first task
+_APP = None
+
+def render(env, paths):
+    global _APP # pylint: disable=global-statement
+    if _APP is None:
+        _APP = apkvitrine.cgi.APKVitrineApp()
+        # Every page is only rendered once
+        _APP.memcache = None
+
+    evictions = _APP.cache.evictions
+    failed = []
+    for path in paths:
+        status = []
+        _APP.handle(
+            dict(env, PATH_INFO="/" + path),
+            lambda i, _, status=status: status.append(i),
+        )
+        if not status[0].startswith("200 "):
+            failed.append((path, status[0]))
+    return len(paths), failed, _APP.cache.evictions - evictions
+
+def list_pages(conf, branches):
+    data = Path(conf[apkvitrine.DEFAULT]["cgi.data"])
+    pages = ["-/versions"]
+    for branch in branches:
+        db = data / f"{branch}.sqlite"
+        if branch not in conf or not db.is_file():
+            logging.warning("Skipping %s: no such branch", branch)
+            continue
+
+        try:
+            db = sqlite3.connect(f"{db.resolve().as_uri()}?mode=ro", uri=True)
+            names = apkvitrine.models.get_names(db)
+            db.close()
+        except sqlite3.OperationalError as e:
+            logging.warning("Skipping %s: %s", branch, e)
+            continue
+
+        pages += [branch, f"{branch}/-/search"]
+        pages += [f"{branch}/{name}" for name in names]
+    return pages
+
+def prerender(opts):
+    conf = apkvitrine.config()
+    if not conf[apkvitrine.DEFAULT].get("cgi.cache"):
+        logging.error("cgi.cache is not set")
+        return False
+
+    branches = opts.branches
+    if not branches:
+        data = Path(conf[apkvitrine.DEFAULT]["cgi.data"])
+        branches = [
+            i for i in conf.sections()
+            if i != apkvitrine.BUILDERS and (data / f"{i}.sqlite").is_file()
+        ]
+    pages = list_pages(conf, branches)
+
+    # Each page is also stored compressed, which counts as an entry
+    entries = conf[apkvitrine.DEFAULT].getint("cgi.cache_entries")
+    files = len(pages) * len(apkvitrine.pagecache.ENCODINGS)
+    if entries and files > entries:
+        logging.warning(
+            "Only %d of %d pages fit in the cache (cgi.cache_entries)",
+            entries // len(apkvitrine.pagecache.ENCODINGS), len(pages),
+        )
+
+    env = {"SCRIPT_NAME": opts.script_name, "QUERY_STRING": ""}
+    if opts.host:
+        env["HTTP_HOST"] = opts.host
+    chunks = [
+        pages[i:i + CHUNK_SIZE] for i in range(0, len(pages), CHUNK_SIZE)
+    ]
+
+    start = time.perf_counter()
+    done = evictions = 0
+    failed = []
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=opts.processes)
+    with pool:
+        results = pool.map(functools.partial(render, env), chunks)
+        for n, chunk_failed, chunk_evictions in results:
+            done += n
+            failed += chunk_failed
+            evictions += chunk_evictions
+            logging.debug("Rendered %d of %d pages", done, len(pages))
+    elapsed = time.perf_counter() - start
+
+    for path, status in failed:
+        logging.error("Failed to render %s: %s", path, status)
+    if evictions:
+        logging.warning(
+            "%d cached files were evicted to make room; raise cgi.cache_size"
+            " or cgi.cache_entries to keep every page",
+            evictions,
+        )
+    logging.info(
+        "Rendered %d pages in %.1f seconds (%.1f pages per second)",
+        done, elapsed, done / elapsed if elapsed else 0,
+    )
+    return not failed
+
+if __name__ == "__main__":
+    opts = argparse.ArgumentParser(
+        usage="python3 -m apkvitrine.prerender [options ...] [BRANCH ...]",
+        description="render every page of the web application into cgi.cache",
+    )
+    opts.add_argument(
+        "-P", "--processes", type=int, default=os.cpu_count(),
+        help="number of processes rendering pages at once",
+    )
+    opts.add_argument(
+        "-H", "--host", default="",
+        help="host name that the pages are served under",
+    )
+    opts.add_argument(
+        "-s", "--script-name", default="",
+        help="URL path that the pages are served under, e.g. /pkg",
+    )
+    opts.add_argument(
+        "-v", "--verbose", dest="loglevel",
+        action="store_const", const="DEBUG", default="INFO",
+        help="show progress",
+    )
+    opts.add_argument(
+        "branches", metavar="BRANCH", nargs="*",
+        help="which branches to render (default: all of them)",
+    )
+    opts = opts.parse_args()
+    logging.basicConfig(level=opts.loglevel)
+
+    sys.exit(0 if prerender(opts) else 1)
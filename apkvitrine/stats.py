@@ -0,0 +1,108 @@
+# SPDX-License-Identifier: NCSA
+# Copyright (c) 2021 Max Rees
+# See LICENSE for more information.
+import collections # Counter
+import contextlib  # contextmanager
+import resource    # getrusage, RUSAGE_SELF, RUSAGE_THREAD
+import threading   # Lock
+import time        # perf_counter, process_time
+
+import apkvitrine.version # cache_info
+
+# Counters shared by every thread of the current build, e.g. HTTP
+# requests and bytes, or time spent in work that runs on a thread pool
+_COUNTERS = collections.Counter()
+_LOCK = threading.Lock()
+
+def count(name, n=1):
+    with _LOCK:
+        _COUNTERS[name] += n
+
+def counters():
+    with _LOCK:
+        return dict(_COUNTERS)
+
+def reset():
+    with _LOCK:
+        _COUNTERS.clear()
+
+def _thread_time():
+    # Like time.thread_time(), which needs Python 3.7. Only Linux has
+    # RUSAGE_THREAD, so elsewhere the whole process is counted.
+    usage = resource.getrusage(
+        getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF),
+    )
+    return usage.ru_utime + usage.ru_stime
+
+@contextlib.contextmanager
+def timer(name):
+    # Safe to use from worker threads; overlapping work is summed
+    wall = time.perf_counter()
+    cpu = _thread_time()
+    try:
+        yield
+    finally:
+        with _LOCK:
+            _COUNTERS[f"{name}.wall"] += time.perf_counter() - wall
+            _COUNTERS[f"{name}.cpu"] += _thread_time() - cpu
+
+def _vercmp_calls():
+    info = apkvitrine.version.cache_info()
+    return {
+        "vercmp.calls": info["vercmp"].hits + info["vercmp"].misses,
+        "vercmp.misses": info["vercmp"].misses,
+        "verkey.misses": info["verkey"].misses,
+    }
+
+def _max_rss():
+    # KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+@contextlib.contextmanager
+def phase(report, name, db=None):
+    # Phases run one after another on the main thread, so the process
+    # wide measurements belong to the phase
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    rows = db.total_changes if db else 0
+    start = {**_vercmp_calls(), **counters()}
+
+    yield
+
+    end = {**_vercmp_calls(), **counters()}
+    report["phases"][name] = {
+        "wall": time.perf_counter() - wall,
+        "cpu": time.process_time() - cpu,
+        "rows": (db.total_changes if db else 0) - rows,
+        "max_rss": _max_rss(),
+        **{
+            key: value - start.get(key, 0) for key, value in end.items()
+            if value != start.get(key, 0)
+        },
+    }
+
+def start(version):
+    return {
+        "version": version,
+        "started": time.time(),
+        "phases": {},
+    }
+
+def tables(db):
+    # Whatever row_factory the models left behind does not apply here
+    cur = db.cursor()
+    cur.row_factory = None
+    names = cur.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'"
+        " AND name NOT LIKE 'sqlite_%';"
+    ).fetchall()
+    return {
+        table: cur.execute(f"SELECT COUNT(*) FROM {table};").fetchone()[0]
+        for table, in names
+    }
+
+def finish(report):
+    report["finished"] = time.time()
+    report["max_rss"] = _max_rss()
+    report["counters"] = counters()
+    return report
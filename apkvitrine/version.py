@@ -1,9 +1,15 @@
 # SPDX-License-Identifier: NCSA
-# Copyright (c) 2018-2020 Max Rees
+# Copyright (c) 2018-2021 Max Rees
 # See LICENSE for more information.
+import argparse  # ArgumentParser
 import ctypes    # c_char_p, CDLL, c_int, c_long, Structure
 import enum      # IntFlag
-import functools # cmp_to_key
+import functools # lru_cache
+import random    # Random
+import sys       # exit
+from pathlib import Path
+
+import apkvitrine.apkindex # fetch
 
 class APK_VER(enum.IntFlag):
     UNKNOWN = 0
@@ -23,6 +29,164 @@ APK_OPS = {
     "~": APK_VER.EQUAL,
 }
 
+# Token types from libapk's version.c, in the same order
+_TOKEN_INVALID = -1
+_TOKEN_DIGIT_OR_ZERO = 0
+_TOKEN_DIGIT = 1
+_TOKEN_LETTER = 2
+_TOKEN_SUFFIX = 3
+_TOKEN_SUFFIX_NO = 4
+_TOKEN_REVISION_NO = 5
+_TOKEN_END = 6
+
+_PRE_SUFFIXES = ("alpha", "beta", "pre", "rc")
+_POST_SUFFIXES = ("cvs", "svn", "git", "hg", "p")
+
+# When two versions diverge in token type, a later token type sorts
+# lower, except that pre-release suffixes sort below everything
+_RANK_PRE = -_TOKEN_END - 1
+_SUFFIX_RANKS = (_RANK_PRE, -_TOKEN_SUFFIX)
+
+_DIGITS = "0123456789"
+
+# Bounds for the memoized verkey() and vercmp() results
+VERKEY_CACHE_SIZE = 65536
+VERCMP_CACHE_SIZE = 262144
+
+def _next_token(t, s, i):
+    n = _TOKEN_INVALID
+
+    if i >= len(s) or s[i] == "\0":
+        n = _TOKEN_END
+    elif t in (_TOKEN_DIGIT, _TOKEN_DIGIT_OR_ZERO) and "a" <= s[i] <= "z":
+        n = _TOKEN_LETTER
+    elif t == _TOKEN_LETTER and s[i] in _DIGITS:
+        n = _TOKEN_DIGIT
+    elif t == _TOKEN_SUFFIX and s[i] in _DIGITS:
+        n = _TOKEN_SUFFIX_NO
+    else:
+        if s[i] == ".":
+            n = _TOKEN_DIGIT_OR_ZERO
+        elif s[i] == "_":
+            n = _TOKEN_SUFFIX
+        elif s[i] == "-" and s[i + 1:i + 2] == "r":
+            n = _TOKEN_REVISION_NO
+            i += 1
+        i += 1
+
+    if n < t and not (
+            (n == _TOKEN_DIGIT_OR_ZERO and t == _TOKEN_DIGIT)
+            or (n == _TOKEN_SUFFIX and t == _TOKEN_SUFFIX_NO)
+            or (n == _TOKEN_DIGIT and t == _TOKEN_LETTER)):
+        n = _TOKEN_INVALID
+
+    return n, i
+
+def _get_token(t, s, i):
+    if i >= len(s):
+        return 0, _TOKEN_END, i
+
+    v = 0
+    j = i
+    nt = _TOKEN_INVALID
+    if t == _TOKEN_DIGIT_OR_ZERO and s[j] == "0":
+        # Leading zero digits get a special treatment; the last zero is
+        # left to be read as a digit
+        while j + 1 < len(s) and s[j + 1] == "0":
+            j += 1
+        nt = _TOKEN_DIGIT
+        v = i - j
+    elif t in (
+            _TOKEN_DIGIT_OR_ZERO, _TOKEN_DIGIT,
+            _TOKEN_SUFFIX_NO, _TOKEN_REVISION_NO):
+        while j < len(s) and s[j] in _DIGITS:
+            j += 1
+        if j > i:
+            # libapk accumulates into a C int
+            v = (int(s[i:j]) + 2**31) % 2**32 - 2**31
+    elif t == _TOKEN_LETTER:
+        v = ord(s[j])
+        j += 1
+    elif t == _TOKEN_SUFFIX:
+        for v, suffix in enumerate(_PRE_SUFFIXES, -len(_PRE_SUFFIXES)):
+            if s.startswith(suffix, i):
+                break
+        else:
+            for v, suffix in enumerate(_POST_SUFFIXES):
+                if s.startswith(suffix, i):
+                    break
+            else:
+                return -1, _TOKEN_INVALID, i
+        nt = _TOKEN_SUFFIX_NO
+        j += len(suffix)
+    else:
+        return -1, _TOKEN_INVALID, i
+
+    if j >= len(s):
+        t = _TOKEN_END
+    elif nt != _TOKEN_INVALID:
+        t = nt
+    else:
+        t, j = _next_token(t, s, j)
+
+    return v, t, j
+
+@functools.lru_cache(maxsize=VERKEY_CACHE_SIZE)
+def verkey(ver):
+    # The key alternates token ranks and token values, ending with the
+    # rank of the terminating END or INVALID token. Comparing two keys as
+    # tuples walks both versions in lockstep, just like libapk does.
+    key = []
+    t = _TOKEN_DIGIT
+    i = 0
+    while t not in (_TOKEN_END, _TOKEN_INVALID):
+        v, nt, i = _get_token(t, ver, i)
+        key.append(_RANK_PRE if t == _TOKEN_SUFFIX and v < 0 else -t)
+        key.append(v)
+        t = nt
+    key.append(-t)
+    return tuple(key)
+
+def keycmp(a, b, fuzzy=False):
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x == y:
+            continue
+        # Token types differ (rather than values) - a fuzzy match only
+        # requires one version to be a prefix of the other
+        if fuzzy and not i % 2 \
+                and not (x in _SUFFIX_RANKS and y in _SUFFIX_RANKS):
+            break
+        return APK_VER.LESS if x < y else APK_VER.GREATER
+
+    return APK_VER.EQUAL
+
+@functools.lru_cache(maxsize=VERCMP_CACHE_SIZE)
+def vercmp(a, b, fuzzy=False):
+    return keycmp(verkey(a), verkey(b), fuzzy)
+
+def cache_info():
+    return {
+        "verkey": verkey.cache_info(),
+        "vercmp": vercmp.cache_info(),
+    }
+
+def cache_clear():
+    verkey.cache_clear()
+    vercmp.cache_clear()
+
+def ver_is(a, op, b):
+    if op not in APK_OPS:
+        raise ValueError("Invalid op " + repr(op))
+
+    fuzzy = "~" in op
+    return vercmp(a, b, fuzzy) & APK_OPS[op]
+
+def is_older(old, new):
+    return vercmp(old, new) == APK_VER.LESS
+
+def is_same(old, new):
+    return vercmp(old, new) == APK_VER.EQUAL
+
 class _apk_blob_t(ctypes.Structure): # pylint: disable=too-few-public-methods
     _fields_ = [
         ("len", ctypes.c_long),
@@ -35,40 +199,60 @@ class _apk_blob_t(ctypes.Structure): # pylint: disable=too-few-public-methods
         self.len = len(s)
         self.ptr = ctypes.c_char_p(s)
 
-def vercmp(a, b, fuzzy=False):
+@functools.lru_cache(maxsize=None)
+def _libapk():
+    lib = ctypes.CDLL("libapk.so.3.12.0")
+    lib.apk_version_compare_blob_fuzzy.argtypes = [
+        _apk_blob_t, _apk_blob_t, ctypes.c_int,
+    ]
+    lib.apk_version_compare_blob_fuzzy.restype = ctypes.c_int
+    return lib
+
+def libapk_vercmp(a, b, fuzzy=False):
     a = _apk_blob_t(a)
     b = _apk_blob_t(b)
     fuzzy = 1 if fuzzy else 0
-    return APK_VER(_LIBAPK.apk_version_compare_blob_fuzzy(a, b, fuzzy))
+    return APK_VER(_libapk().apk_version_compare_blob_fuzzy(a, b, fuzzy))
 
-@functools.cmp_to_key
-def verkey(a, b):
-    r = vercmp(a, b)
-
-    if r == APK_VER.LESS:
-        return -1
-    if r == APK_VER.EQUAL:
-        return 0
-    if r == APK_VER.GREATER:
-        return 1
-
-    return None
+def check(versions, samples, seed=0):
+    versions = sorted(versions, key=verkey)
+    pairs = list(zip(versions, versions[1:]))
+    rng = random.Random(seed)
+    pairs += [
+        (rng.choice(versions), rng.choice(versions)) for _ in range(samples)
+    ]
 
-def ver_is(a, op, b):
-    if op not in APK_OPS:
-        raise ValueError("Invalid op " + repr(op))
+    bad = 0
+    for a, b in pairs:
+        for fuzzy in (False, True):
+            ours = vercmp(a, b, fuzzy)
+            theirs = libapk_vercmp(a, b, fuzzy)
+            if ours != theirs:
+                print(f"{a!r} {b!r} fuzzy={fuzzy}: {ours!r} != {theirs!r}")
+                bad += 1
 
-    fuzzy = "~" in op
-    return vercmp(a, b, fuzzy) & APK_OPS[op]
+    print(f"{len(versions)} versions, {len(pairs)} pairs, {bad} mismatches")
+    return not bad
 
-def is_older(old, new):
-    return vercmp(old, new) == APK_VER.LESS
+if __name__ == "__main__":
+    opts = argparse.ArgumentParser(
+        usage="python3 -m apkvitrine.version [options ...] INDEX [INDEX ...]",
+        description="check the version ordering against libapk",
+    )
+    opts.add_argument(
+        "-n", "--samples", type=int, default=100000,
+        help="number of random version pairs to compare",
+    )
+    opts.add_argument(
+        "indices", metavar="INDEX", nargs="+",
+        help="URL or path of an APKINDEX.tar.gz from which to take versions",
+    )
+    opts = opts.parse_args()
 
-def is_same(old, new):
-    return vercmp(old, new) == APK_VER.EQUAL
+    versions = set()
+    for url in opts.indices:
+        if "://" not in url:
+            url = Path(url).resolve().as_uri()
+        versions.update(i.version for i in apkvitrine.apkindex.fetch(url))
 
-_LIBAPK = ctypes.CDLL("libapk.so.3.12.0")
-_LIBAPK.apk_version_compare_blob_fuzzy.argtypes = [
-    _apk_blob_t, _apk_blob_t, ctypes.c_int,
-]
-_LIBAPK.apk_version_compare_blob_fuzzy.restype = ctypes.c_int
+    sys.exit(0 if check(versions, opts.samples) else 1)